@@ -1,16 +1,51 @@
 ##
 ## FILE WHERE WE DEFINE THE APP
 ## AND INIT STUFF LIKE DB, MARSHMALLOW, BCRYPT
+## create_app() builds a complete app (config, extensions, blueprints, metrics hooks),
+## the routes and services only know current_app. run.py builds the app of the process,
+## the background services (encoding, deletions, views, token store) serve the app
+## that started them
 ##
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
+from services.database import RoutingSQLAlchemy
 
-db = SQLAlchemy(app)
-ma = Marshmallow(app)
-flask_bcrypt = Bcrypt(app)
\ No newline at end of file
+db = RoutingSQLAlchemy()
+ma = Marshmallow()
+flask_bcrypt = Bcrypt()
+
+# config: None, a dict of overrides or the path of a settings file, applied last
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_pyfile('config.py')
+    app.config.from_envvar('API_SETTINGS', silent=True) # e.g. API_SETTINGS=config_production.py
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config:
+        app.config.from_pyfile(config)
+
+    db.init_app(app)
+    ma.init_app(app)
+    flask_bcrypt.init_app(app)
+
+    # the routes import the models, which need db and ma above
+    from routes.users import users_api
+    from routes.auth import auth_api
+    from routes.videos import videos_api
+    from routes.uploads import uploads_api
+    from routes.metrics import metrics_api
+    from routes.exports import exports_api
+    from services import metrics
+
+    app.register_blueprint(users_api)
+    app.register_blueprint(auth_api)
+    app.register_blueprint(videos_api)
+    app.register_blueprint(uploads_api)
+    app.register_blueprint(metrics_api)
+    app.register_blueprint(exports_api)
+
+    metrics.init_app(app) # route timings and SQL counts for /metrics
+    return app
@@ -0,0 +1,18 @@
+##
+## FILE WHERE WE RUN THE APP ON AN ASGI SERVER (asyncio)
+## same routes as run.py, the connections live on the event loop (see services/asgi.py)
+## run with `uvicorn asgi:application --port 1407` (pip install uvicorn)
+##
+
+from run import app, startup
+
+from services.asgi import WsgiBridge
+
+application = WsgiBridge(
+    app.wsgi_app,
+    threads = app.config['ASGI_THREADS'],
+    spool_size = app.config['ASGI_SPOOL_SIZE'],
+    send_size = app.config['ASGI_SEND_SIZE'],
+    max_body = app.config['MAX_CONTENT_LENGTH'],
+    startup = startup, # migrations, search index and background workers, on lifespan startup
+)
@@ -0,0 +1,193 @@
+##
+## FILE WHERE WE GENERATE THE BENCHMARK DATASET
+## bulk-populates an empty database with users, videos, formats, comments and tokens,
+## the same seed and scale always give the same rows. a manifest (<database>.json) is
+## written next to it for the load driver: counts, credentials, tokens, sample files
+##
+## python -m benchmarks.dataset --scale 10k --database sqlite:///bench.db
+##
+
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BATCH_SIZE = 10000
+SAMPLE_FILES = 4
+SAMPLE_SIZE = 1024 * 1024
+FORMATS = ['240', '360', '480', '720', '1080']
+PASSWORD = 'benchmark'
+TOKENS = 200 # tokens kept in the manifest, for the first users
+WORDS = [
+    'cat', 'dog', 'tutorial', 'live', 'music', 'trailer', 'review', 'gaming', 'travel', 'cooking',
+    'news', 'football', 'concert', 'vlog', 'unboxing', 'science', 'history', 'comedy', 'remix', 'podcast',
+]
+MP4_HEADER = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom'
+
+# '10k' -> 10000, '2.5m' -> 2500000
+def parse_scale(value):
+    units = {'k': 1000, 'm': 1000000}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def manifest_path(database):
+    return database.split('///', 1)[-1] + '.json'
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def insert(db, table, rows):
+    count = 0
+    for batch in batches(rows):
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+def sample_files(app, rng):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    files = []
+    for k in range(SAMPLE_FILES):
+        filename = 'bench_%d.mp4' % k
+        with open(app.config['UPLOAD_FOLDER'] + filename, 'wb') as sample:
+            size = SAMPLE_SIZE - len(MP4_HEADER)
+            sample.write(MP4_HEADER + rng.getrandbits(8 * size).to_bytes(size, 'little'))
+        files.append(filename)
+    return files
+
+def generate(scale, seed, database, users=None, comments_per_video=3, formats_per_video=2):
+    from app import create_app, db
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'SQLALCHEMY_ECHO': False})
+
+    from sqlalchemy import text
+    import jwt
+    import migrations
+    from models import User, Video, Video_Format, Comment, Token
+    from services import counters, hashing, search, sessions
+
+    rng = random.Random(seed)
+    videos = scale
+    users = users or max(1, videos // 10)
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=365)
+    counts = {}
+
+    with app.app_context():
+        migrations.upgrade()
+        if db.session.query(User.id).first() is not None:
+            raise SystemExit('%s is not empty, the generator only fills a new database' % database)
+
+        password = hashing.hash_password(PASSWORD) # one hash for everyone, bcrypt per row would take hours
+        files = sample_files(app, rng)
+
+        def user_rows():
+            for i in range(1, users + 1):
+                yield {
+                    'id': i,
+                    'username': 'user%d' % i,
+                    'email': 'user%d@bench.local' % i,
+                    'pseudo': rng.choice(WORDS) + str(i) if rng.random() < 0.5 else None,
+                    'password': password,
+                    'created_at': start + timedelta(seconds=i),
+                }
+
+        # video v belongs to user ((v - 1) % users) + 1, the driver relies on it
+        def video_rows():
+            step = 365 * 24 * 3600 / max(1, videos)
+            for v in range(1, videos + 1):
+                yield {
+                    'id': v,
+                    'source': app.config['UPLOAD_FOLDER'] + files[v % len(files)],
+                    'name': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+                    'view': rng.randint(0, 100000),
+                    'enabled': True,
+                    'user_id': (v - 1) % users + 1,
+                    'created_at': start + timedelta(seconds=int(v * step)),
+                }
+
+        def format_rows():
+            for v in range(1, videos + 1):
+                for code in rng.sample(FORMATS, rng.randint(0, min(len(FORMATS), 2 * formats_per_video))):
+                    yield {
+                        'code': code,
+                        'uri': app.config['UPLOAD_FOLDER'] + files[v % len(files)],
+                        'video_id': v,
+                    }
+
+        def comment_rows():
+            for v in range(1, videos + 1):
+                for _ in range(rng.randint(0, 2 * comments_per_video)):
+                    yield {
+                        'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+                        'user_id': rng.randint(1, users),
+                        'video_id': v,
+                    }
+
+        tokens = []
+        def token_rows():
+            expired_at = now + timedelta(days=7)
+            for i in range(1, users + 1):
+                token = jwt.encode({'id': i, 'exp': expired_at, 'jti': '%x' % rng.getrandbits(64)}, app.config['SECRET_KEY'])
+                if len(tokens) < TOKENS:
+                    tokens.append({'user_id': i, 'token': token.decode('utf-8') if isinstance(token, bytes) else token})
+                yield {'code': sessions.code_hash(token), 'expired_at': expired_at, 'user_id': i}
+
+        started = time.monotonic()
+        for name, model, rows in (
+            ('users', User, user_rows()),
+            ('videos', Video, video_rows()),
+            ('formats', Video_Format, format_rows()),
+            ('comments', Comment, comment_rows()),
+            ('tokens', Token, token_rows()),
+        ):
+            counts[name] = insert(db, model.__table__, rows)
+            print('%-8s %10d rows  %6.1fs' % (name, counts[name], time.monotonic() - started), file=sys.stderr)
+
+        counters.repair() # comment_count / format_count of the new videos
+        search.available() # backfills the full-text index from the new rows
+        with db.engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+
+    manifest = {
+        'seed': seed,
+        'scale': scale,
+        'database': database,
+        'generated_at': now.isoformat(),
+        'counts': counts,
+        'password': PASSWORD,
+        'tokens': tokens,
+        'files': files,
+        'formats': FORMATS,
+        'words': WORDS,
+    }
+    with open(manifest_path(database), 'w') as out:
+        json.dump(manifest, out, indent=2)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='populate a new database for the benchmarks')
+    parser.add_argument('--scale', default='10k', help='number of videos: 10k, 1m, 10m...')
+    parser.add_argument('--users', type=parse_scale, default=None, help='default: scale / 10')
+    parser.add_argument('--comments-per-video', type=int, default=3, help='average')
+    parser.add_argument('--formats-per-video', type=int, default=2, help='average')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', default='sqlite:///bench.db')
+    args = parser.parse_args()
+
+    manifest = generate(
+        parse_scale(args.scale), args.seed, args.database,
+        users=args.users, comments_per_video=args.comments_per_video, formats_per_video=args.formats_per_video
+    )
+    print(json.dumps(manifest['counts']))
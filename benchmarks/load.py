@@ -0,0 +1,508 @@
+##
+## FILE WHERE WE DRIVE THE LOAD BENCHMARKS
+## runs every scenario (one per route, uploads included) with N concurrent clients and
+## reports p50/p95/p99 latency, throughput and SQL queries per request as JSON, so runs
+## can be compared across commits. in-process by default (WSGI test client, queries are
+## counted), or against a running server with --url (queries are not visible from there)
+##
+## python -m benchmarks.dataset --scale 10k --database sqlite:///bench.db
+## python -m benchmarks.load --database sqlite:///bench.db --concurrency 8 --duration 10
+## python -m benchmarks.load --database sqlite:///bench.db --compare benchmarks/results/<previous>.json
+##
+
+from datetime import datetime
+import argparse
+import hashlib
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+from benchmarks.dataset import MP4_HEADER, manifest_path
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(__file__), 'results')
+
+#################
+#### CLIENTS ####
+#################
+
+# both clients: request(method, path, headers, body) -> (status, body)
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, body=None):
+        response = self.client.open(path, method=method, headers=headers or {}, data=body)
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+
+class HttpClient:
+    def __init__(self, url):
+        self.url = urllib.parse.urlsplit(url)
+        self.connection = None
+
+    def request(self, method, path, headers=None, body=None):
+        for attempt in (0, 1): # the server may have closed the keep-alive connection
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+            try:
+                self.connection.request(method, self.url.path.rstrip('/') + path, body=body, headers=headers or {})
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+def json_body(data):
+    return {'Content-Type': 'application/json'}, json.dumps(data).encode('utf-8')
+
+def multipart_body(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)).encode('utf-8'))
+    for name, (filename, content) in files.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: video/mp4\r\n\r\n' % (boundary, name, filename)).encode('utf-8'))
+        parts.append(content + b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    return {'Content-Type': 'multipart/form-data; boundary=%s' % boundary}, b''.join(parts)
+
+###################
+#### SCENARIOS ####
+###################
+
+# a scenario runs one operation and returns the list of statuses of the requests it made
+
+class Context:
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.users = manifest['counts']['users']
+        self.videos = manifest['counts']['videos']
+        self.tokens = manifest['tokens']
+        self.sequence = itertools.count(1)
+        self.run = uuid.uuid4().hex[:8] # names created by this run never collide with an earlier one
+        self.video = MP4_HEADER + os.urandom(64 * 1024)
+
+    def unique(self, prefix):
+        return '%s%s%d' % (prefix, self.run, next(self.sequence))
+
+    def principal(self, rng):
+        entry = rng.choice(self.tokens)
+        return entry['user_id'], {'x-token': entry['token']}
+
+    # a video of the user, see the ownership rule in benchmarks/dataset.py
+    def video_of(self, rng, userId):
+        owned = (self.videos - userId) // self.users + 1 if userId <= self.videos else 0
+        return userId + self.users * rng.randrange(owned) if owned else rng.randint(1, self.videos)
+
+    def any_video(self, rng):
+        return rng.randint(1, self.videos)
+
+    def any_user(self, rng):
+        return rng.randint(1, self.users)
+
+    def word(self, rng):
+        return rng.choice(self.manifest['words'])
+
+def page(rng, ctx, total):
+    return rng.randint(1, max(1, min(50, total // 20)))
+
+def users_list(client, ctx, rng):
+    return [client.request('GET', '/users?page=%d' % page(rng, ctx, ctx.users))[0]]
+
+def users_list_cursor(client, ctx, rng):
+    status, body = client.request('GET', '/users?limit=20')
+    statuses = [status]
+    cursor = json.loads(body)['pager'].get('next') if status == 200 else None
+    if cursor:
+        statuses.append(client.request('GET', '/users?limit=20&cursor=' + urllib.parse.quote(cursor))[0])
+    return statuses
+
+def users_search(client, ctx, rng):
+    return [client.request('GET', '/users?q=' + ctx.word(rng)[:3])[0]]
+
+def users_get(client, ctx, rng):
+    return [client.request('GET', '/user/%d' % ctx.any_user(rng))[0]]
+
+def users_get_own(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    return [client.request('GET', '/user/%d' % userId, headers)[0]]
+
+def users_batch(client, ctx, rng):
+    return [client.request('GET', '/users/batch?ids=' + ','.join(str(ctx.any_user(rng)) for _ in range(20)))[0]]
+
+def users_create(client, ctx, rng):
+    name = ctx.unique('bench')
+    headers, body = json_body({'username': name, 'email': name + '@bench.local', 'password': ctx.manifest['password']})
+    return [client.request('POST', '/user', headers, body)[0]]
+
+def users_update(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = json_body({'username': 'user%d' % userId, 'email': 'user%d@bench.local' % userId, 'password': ctx.manifest['password']})
+    headers.update(extra)
+    return [client.request('PUT', '/user/%d' % userId, headers, body)[0]]
+
+def users_delete(client, ctx, rng):
+    name = ctx.unique('gone')
+    headers, body = json_body({'username': name, 'email': name + '@bench.local', 'password': ctx.manifest['password']})
+    status, created = client.request('POST', '/user', headers, body)
+    if status != 201:
+        return [status]
+    headers, body = json_body({'login': name, 'password': ctx.manifest['password']})
+    login, token = client.request('POST', '/auth', headers, body)
+    if login != 200:
+        return [status, login]
+    userId = json.loads(created)['data']['id']
+    return [status, login, client.request('DELETE', '/user/%d' % userId, {'x-token': json.loads(token)['data']})[0]]
+
+def auth_login(client, ctx, rng):
+    headers, body = json_body({'login': 'user%d' % ctx.any_user(rng), 'password': ctx.manifest['password']})
+    return [client.request('POST', '/auth', headers, body)[0]]
+
+def auth_logout(client, ctx, rng):
+    headers, body = json_body({'login': 'user%d' % ctx.any_user(rng), 'password': ctx.manifest['password']})
+    status, token = client.request('POST', '/auth', headers, body)
+    if status != 200:
+        return [status]
+    return [status, client.request('DELETE', '/auth', {'x-token': json.loads(token)['data']})[0]]
+
+def videos_list(client, ctx, rng):
+    return [client.request('GET', '/videos?page=%d' % page(rng, ctx, ctx.videos))[0]]
+
+def videos_list_cursor(client, ctx, rng):
+    return [client.request('GET', '/videos?limit=20')[0]]
+
+def videos_search(client, ctx, rng):
+    return [client.request('GET', '/videos?q=%s+%s' % (ctx.word(rng), ctx.word(rng)[:2]))[0]]
+
+def videos_by_user(client, ctx, rng):
+    return [client.request('GET', '/user/%d/videos' % ctx.any_user(rng))[0]]
+
+def videos_comments(client, ctx, rng):
+    return [client.request('GET', '/video/%d/comments' % ctx.any_video(rng))[0]]
+
+def videos_batch(client, ctx, rng):
+    return [client.request('GET', '/videos/batch?ids=' + ','.join(str(ctx.any_video(rng)) for _ in range(20)))[0]]
+
+def exports_videos(client, ctx, rng):
+    return [client.request('GET', '/export/videos?fields=id,name&after=%d' % max(0, ctx.videos - 1000))[0]]
+
+def videos_comment(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = json_body({'body': ' '.join(ctx.word(rng) for _ in range(8))})
+    headers.update(extra)
+    return [client.request('POST', '/video/%d/comment' % ctx.any_video(rng), headers, body)[0]]
+
+def videos_comment_batch(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = json_body({'comments': [
+        {'video_id': ctx.any_video(rng), 'body': ' '.join(ctx.word(rng) for _ in range(8))} for _ in range(10)
+    ]})
+    headers.update(extra)
+    return [client.request('POST', '/comments/batch', headers, body)[0]]
+
+def videos_create(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = multipart_body({'name': ctx.unique('bench ')}, {'source': ('bench.mp4', ctx.video)})
+    headers.update(extra)
+    return [client.request('POST', '/user/%d/video' % userId, headers, body)[0]]
+
+def videos_update(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = json_body({'name': ' '.join(ctx.word(rng) for _ in range(3))})
+    headers.update(extra)
+    return [client.request('PUT', '/video/%d' % ctx.video_of(rng, userId), headers, body)[0]]
+
+def videos_delete(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    upload_headers, body = multipart_body({'name': ctx.unique('gone ')}, {'source': ('gone.mp4', ctx.video)})
+    upload_headers.update(headers)
+    status, created = client.request('POST', '/user/%d/video' % userId, upload_headers, body)
+    if status != 201:
+        return [status]
+    return [status, client.request('DELETE', '/video/%d' % json.loads(created)['data']['id'], headers)[0]]
+
+def videos_encode(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    extra, body = multipart_body({'format': rng.choice(ctx.manifest['formats'])}, {'file': ('encoded.mp4', ctx.video)})
+    headers.update(extra)
+    return [client.request('PATCH', '/video/%d' % ctx.video_of(rng, userId), headers, body)[0]]
+
+def videos_encode_job(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    headers = dict(headers)
+    videoId = ctx.video_of(rng, userId)
+    extra, body = json_body({'format': rng.choice(ctx.manifest['formats'])})
+    headers.update(extra)
+    status, created = client.request('PATCH', '/video/%d' % videoId, headers, body)
+    if status != 202:
+        return [status]
+    jobId = json.loads(created)['data']['id']
+    return [status, client.request('GET', '/job/%d' % jobId)[0], client.request('GET', '/video/%d/jobs' % videoId)[0]]
+
+def videos_view(client, ctx, rng):
+    return [client.request('POST', '/video/%d/view' % ctx.any_video(rng))[0]]
+
+def uploads_get(client, ctx, rng):
+    return [client.request('GET', '/uploads/' + rng.choice(ctx.manifest['files']))[0]]
+
+def uploads_range(client, ctx, rng):
+    start = rng.randrange(0, 1024 * 1024 - 65536)
+    return [client.request('GET', '/uploads/' + rng.choice(ctx.manifest['files']), {'Range': 'bytes=%d-%d' % (start, start + 65535)})[0]]
+
+# resumable upload: create the session, send two chunks, finalize
+def uploads_chunked(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    content = ctx.video
+    create_headers, body = json_body({'filename': 'chunked.mp4', 'name': ctx.unique('chunked '), 'size': len(content)})
+    create_headers.update(headers)
+    status, created = client.request('POST', '/user/%d/upload' % userId, create_headers, body)
+    statuses = [status]
+    if status != 201:
+        return statuses
+    uploadId = json.loads(created)['data']['id']
+    half = len(content) // 2
+    for start, end in ((0, half - 1), (half, len(content) - 1)):
+        chunk_headers = dict(headers)
+        chunk_headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(content))
+        chunk_headers['Content-Type'] = 'application/octet-stream'
+        statuses.append(client.request('PUT', '/upload/%s' % uploadId, chunk_headers, content[start:end + 1])[0])
+    finalize_headers, body = json_body({'sha256': hashlib.sha256(content).hexdigest()})
+    finalize_headers.update(headers)
+    statuses.append(client.request('POST', '/upload/%s' % uploadId, finalize_headers, body)[0])
+    return statuses
+
+def uploads_status(client, ctx, rng):
+    userId, headers = ctx.principal(rng)
+    create_headers, body = json_body({'filename': 'abandoned.mp4', 'size': 1024})
+    create_headers.update(headers)
+    status, created = client.request('POST', '/user/%d/upload' % userId, create_headers, body)
+    if status != 201:
+        return [status]
+    uploadId = json.loads(created)['data']['id']
+    return [status, client.request('GET', '/upload/%s' % uploadId, headers)[0], client.request('DELETE', '/upload/%s' % uploadId, headers)[0]]
+
+# name -> scenario, every route is covered except POST /job/<id>/retry (needs a dead-lettered job)
+SCENARIOS = {
+    'auth.login': auth_login,
+    'auth.logout': auth_logout,
+    'users.list': users_list,
+    'users.list_cursor': users_list_cursor,
+    'users.search': users_search,
+    'users.get': users_get,
+    'users.get_own': users_get_own,
+    'users.batch': users_batch,
+    'users.create': users_create,
+    'users.update': users_update,
+    'users.delete': users_delete,
+    'videos.list': videos_list,
+    'videos.list_cursor': videos_list_cursor,
+    'videos.search': videos_search,
+    'videos.by_user': videos_by_user,
+    'videos.comments': videos_comments,
+    'videos.comment': videos_comment,
+    'videos.batch': videos_batch,
+    'videos.comment_batch': videos_comment_batch,
+    'videos.create': videos_create,
+    'videos.update': videos_update,
+    'videos.delete': videos_delete,
+    'videos.encode': videos_encode,
+    'videos.encode_job': videos_encode_job,
+    'videos.view': videos_view,
+    'exports.videos': exports_videos,
+    'uploads.get': uploads_get,
+    'uploads.range': uploads_range,
+    'uploads.chunked': uploads_chunked,
+    'uploads.status': uploads_status,
+}
+
+################
+#### RUNNER ####
+################
+
+_local = threading.local()
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    if hasattr(_local, 'queries'):
+        _local.queries += 1
+
+def percentile(values, p):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1)) # nearest rank
+    return values[index]
+
+def run_scenario(name, make_client, ctx, concurrency, duration, operations, seed, count):
+    latencies = []
+    statuses = {}
+    requests = [0]
+    queries = [0]
+    failures = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    remaining = itertools.count()
+
+    def worker(index):
+        client = make_client()
+        rng = random.Random('%s:%s:%d' % (seed, name, index))
+        local_latencies, local_statuses, local_requests = [], {}, 0
+        _local.queries = 0
+        while time.monotonic() < deadline if operations is None else next(remaining) < operations:
+            started = time.perf_counter()
+            try:
+                codes = SCENARIOS[name](client, ctx, rng)
+            except Exception as err:
+                codes = ['error']
+                with lock:
+                    failures.append(repr(err))
+            local_latencies.append(time.perf_counter() - started)
+            local_requests += len(codes)
+            for code in codes:
+                key = code if code == 'error' else '%dxx' % (code // 100)
+                local_statuses[key] = local_statuses.get(key, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            requests[0] += local_requests
+            queries[0] += _local.queries
+            for key, value in local_statuses.items():
+                statuses[key] = statuses.get(key, 0) + value
+        del _local.queries
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return {
+        'operations': len(latencies),
+        'requests': requests[0],
+        'statuses': statuses,
+        'errors': statuses.get('5xx', 0) + statuses.get('error', 0),
+        'failures': sorted(set(failures))[:5],
+        'elapsed_s': round(elapsed, 3),
+        'throughput_ops': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'throughput_rps': round(requests[0] / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'queries_per_request': round(queries[0] / requests[0], 2) if count and requests[0] else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current, previous):
+    lines = ['%-22s %12s %12s %10s %12s %12s' % ('scenario', 'p95 before', 'p95 after', 'p95', 'ops/s before', 'ops/s after')]
+    for name, result in current['scenarios'].items():
+        before = previous['scenarios'].get(name)
+        if before is None:
+            continue
+        p95, old_p95 = result['latency_ms']['p95'], before['latency_ms']['p95']
+        change = '%+.1f%%' % ((p95 - old_p95) / old_p95 * 100) if p95 and old_p95 else '-'
+        lines.append('%-22s %12s %12s %10s %12s %12s' % (name, old_p95, p95, change, before['throughput_ops'], result['throughput_ops']))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='load benchmarks, one scenario per route')
+    parser.add_argument('--database', default='sqlite:///bench.db', help='generated by benchmarks.dataset, also locates the manifest')
+    parser.add_argument('--url', default=None, help='benchmark a running server instead of the in-process app')
+    parser.add_argument('--scenario', action='append', default=None, help='run only these (repeat), prefix match: --scenario videos.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--operations', type=int, default=None, help='operations per scenario, instead of --duration')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-response-cache', action='store_true', help='in-process only')
+    parser.add_argument('--output', default=None, help='default: benchmarks/results/<time>-<commit>.json')
+    parser.add_argument('--compare', default=None, help='a previous result file')
+    args = parser.parse_args()
+
+    with open(manifest_path(args.database)) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        count = False
+    else:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        from app import create_app
+        config = {'SQLALCHEMY_DATABASE_URI': args.database, 'SQLALCHEMY_ECHO': False}
+        if args.no_response_cache:
+            config['RESPONSE_CACHE'] = None
+        app = create_app(config)
+        event.listen(Engine, 'before_cursor_execute', count_queries)
+        make_client = lambda: InProcessClient(app)
+        count = True
+
+    names = [name for name in SCENARIOS if not args.scenario or any(name.startswith(prefix) for prefix in args.scenario)]
+    ctx = Context(manifest)
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': 'http' if args.url else 'in-process',
+            'url': args.url,
+            'database': args.database,
+            'dataset': {'seed': manifest['seed'], 'scale': manifest['scale'], 'counts': manifest['counts']},
+            'concurrency': args.concurrency,
+            'duration_s': None if args.operations else args.duration,
+            'operations': args.operations,
+            'seed': args.seed,
+            'response_cache': not args.no_response_cache,
+        },
+        'scenarios': {},
+    }
+
+    for name in names:
+        result = run_scenario(name, make_client, ctx, args.concurrency, args.duration, args.operations, args.seed, count)
+        results['scenarios'][name] = result
+        print('%-22s %8d ops %9.1f ops/s  p50 %8s  p95 %8s  p99 %8s ms  q/req %5s  errors %d' % (
+            name, result['operations'], result['throughput_ops'] or 0,
+            result['latency_ms']['p50'], result['latency_ms']['p95'], result['latency_ms']['p99'],
+            result['queries_per_request'], result['errors']
+        ), file=sys.stderr)
+
+    output = args.output or os.path.join(RESULTS_FOLDER, '%s-%s.json' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S'), results['meta']['commit'] or 'nocommit'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    print(output)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            print(compare(results, json.load(previous)))
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,75 @@ SECRET_KEY = 'ticapi'
 SQLALCHEMY_DATABASE_URI = 'sqlite:///api.db'
 UPLOAD_FOLDER = 'uploads/'
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024 * 1024 # chunked uploads, each chunk is still capped by MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # advertised to clients
+UPLOAD_EXPIRY = 24 * 3600 # seconds without a chunk before an upload session and its partial file are dropped
+UPLOAD_SWEEP_INTERVAL = 3600 # seconds between two sweeps of the expired upload sessions
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600 # uploaded files are never rewritten under the same name
+SENDFILE_OFFLOAD = None # None, 'x-accel' (nginx) or 'x-sendfile' (apache, lighttpd)
+SENDFILE_ACCEL_PREFIX = '/protected-uploads/' # nginx internal location aliased to UPLOAD_FOLDER
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# file storage (see services/storage.py), migrate_storage.py moves older files in
+STORAGE_BACKEND = 'local' # 'local' (under UPLOAD_FOLDER), the only one for now
+STORAGE_SHARD_DEPTH = 2 # directory levels of 2 hex chars: uploads/3f/a2/3fa2...mp4
+
 # dev
 DEBUG = True
 SQLALCHEMY_ECHO = True
+
+# pre-fork server (see serve.py)
+SERVE_WORKERS = 0 # processes, 0: one per core
+SERVE_HEARTBEAT = 2 # seconds between two health reports of a worker
+SERVE_WORKER_TIMEOUT = 30 # seconds without a report before a worker is killed and replaced
+SERVE_GRACEFUL_TIMEOUT = 30 # seconds a stopping worker has to finish its requests
+SERVE_STATUS_FILE = 'serve-status.json' # per-worker health, rewritten by the master
+
+# asyncio serving mode (see asgi.py and services/asgi.py)
+ASGI_THREADS = 32 # requests handled at once (a streamed response holds its thread), connections are only bounded by the server
+ASGI_SPOOL_SIZE = 1024 * 1024 # request bodies above this are buffered on disk
+ASGI_SEND_SIZE = 64 * 1024 # response bytes produced per thread hop
+
+# database profile (see services/database.py and config_production.py)
+SQLITE_PRAGMAS = {'busy_timeout': 5000}
+SQLALCHEMY_READ_POOL = False
+
+# password hashing (see services/hashing.py)
+BCRYPT_LOG_ROUNDS = 10
+HASH_WORKERS = 2 # 0 hashes on the request thread
+HASH_QUEUE_SIZE = 32 # hashes waiting for a worker before we answer 503
+HASH_RETRY_AFTER = 1 # seconds
+
+# server-side encoding (see services/encoding.py)
+ENCODER = 'auto' # 'auto' (ffmpeg when installed, else stub), 'ffmpeg' or 'stub'
+ENCODING_WORKERS = 2 # encoder processes running at once
+ENCODING_MAX_ATTEMPTS = 3 # then the job is dead-lettered
+ENCODING_TIMEOUT = 3600 # seconds before an encoder process is killed
+ENCODING_POLL_INTERVAL = 5 # seconds, picks up jobs queued by other workers
+ENCODING_LEASE = 60 # seconds a running job stays claimed without renewal, then it is queued again
+
+# background deletion of videos and users (see services/removal.py)
+DELETION_BATCH_SIZE = 500 # rows per transaction
+DELETION_BATCH_PAUSE = 0.01 # seconds between two batches, other writers get the lock
+DELETION_MAX_ATTEMPTS = 3 # then the deletion is dead-lettered
+DELETION_POLL_INTERVAL = 5 # seconds, picks up deletions queued by other workers
+DELETION_LEASE = 60 # seconds a running deletion stays claimed without renewal, then it is queued again
+
+# instrumentation (see services/metrics.py)
+METRICS_TOKEN = None # when set, /metrics needs 'Authorization: Bearer <METRICS_TOKEN>'
+METRICS_SLOW_QUERY = 0.1 # seconds, slower statements are sampled on /metrics/slow-queries
+METRICS_PROFILE_RATE = 0 # fraction of requests traced with cProfile, e.g. 0.001
+METRICS_PROFILE_FOLDER = 'profiles/' # one .prof file per traced request
+
+# token store (see services/sessions.py)
+TOKEN_REVOCATION_REFRESH = 5 # seconds before a revocation made by another worker is seen
+TOKEN_SWEEP_INTERVAL = 300 # seconds between deletions of expired tokens
+
+# view counter (see services/views.py)
+VIEW_FLUSH_INTERVAL = 10 # seconds, also the most views a crash can lose
+
+# response cache for the public GET routes (see services/response_cache.py)
+RESPONSE_CACHE = 'memory' # None, 'memory' (per process) or 'sqlite' (shared by the workers of one box)
+RESPONSE_CACHE_TTL = 60 # seconds, bounds staleness of what isn't invalidated (view counts)
+RESPONSE_CACHE_SIZE = 4096 # entries, memory backend
+RESPONSE_CACHE_PATH = 'cache.db' # sqlite backend
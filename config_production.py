@@ -0,0 +1,42 @@
+##
+## PRODUCTION OVERRIDES, LOADED AFTER config.py WHEN API_SETTINGS POINTS HERE
+## API_SETTINGS=config_production.py python run.py
+##
+
+from sqlalchemy.pool import QueuePool
+
+DEBUG = False
+SQLALCHEMY_ECHO = False
+
+# applied on every new sqlite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL', # readers don't block the writer and the other way around
+    'synchronous': 'NORMAL', # safe with WAL, fsync only at checkpoints
+    'busy_timeout': 5000, # ms to wait for the write lock instead of 'database is locked'
+    'mmap_size': 268435456, # 256 MB of the file mapped, reads skip the page cache copy
+    'cache_size': -65536, # 64 MB page cache per connection (negative = KiB)
+    'temp_store': 'MEMORY',
+}
+
+# writes: few connections, SQLite has a single writer anyway
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'poolclass': QueuePool,
+    'pool_size': 4,
+    'max_overflow': 4,
+    'pool_timeout': 10,
+    'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False, 'timeout': 5},
+}
+
+# GET/HEAD requests read through their own query_only pool
+SQLALCHEMY_READ_POOL = True
+SQLALCHEMY_READ_ENGINE_OPTIONS = {
+    'poolclass': QueuePool,
+    'pool_size': 16,
+    'max_overflow': 16,
+    'pool_timeout': 10,
+    'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False, 'timeout': 5},
+}
+
+RESPONSE_CACHE = 'sqlite' # shared by the workers of the box
@@ -0,0 +1,129 @@
+##
+## FILE WHERE WE MOVE STORED FILES INTO THE CURRENT STORAGE LAYOUT
+## every uri of Video.source / Video_Format.uri / Blob.uri that is not the sharded blob
+## key of its content (flat uploads/<name> files, or files not yet in the configured
+## backend) is hashed, copied to its blob key, then its rows are pointed at the new uri
+## in one short transaction. the server keeps running: the old file stays readable
+## until the end of the run plus --grace seconds (responses cached with the old uri)
+## run with `python migrate_storage.py [--dry-run] [--limit N] [--grace SECONDS]`
+##
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime
+import argparse
+import os
+import time
+
+from app import create_app, db
+from models import Blob, Video, Video_Format
+from services import blobs, response_cache, storage
+
+BATCH_SIZE = 1000
+
+# every distinct stored uri, in batches (keyset on the uri indexes)
+def stored_uris():
+    for table, column in (('video', 'source'), ('video__format', 'uri'), ('blob', 'uri')):
+        last = ''
+        while True:
+            rows = db.session.execute(
+                text('SELECT DISTINCT %s FROM %s WHERE %s > :last ORDER BY %s LIMIT %d' % (column, table, column, column, BATCH_SIZE)),
+                {'last': last}
+            ).fetchall()
+            db.session.remove()
+            if not rows:
+                break
+            for (uri,) in rows:
+                yield uri
+            last = rows[-1][0]
+
+def layout_key(blob):
+    return storage.blob_key(blob.digest, blobs.extension(blob.uri))
+
+def in_layout(uri):
+    blob = Blob.query.filter_by(uri=uri).first()
+    key = storage.key_of(uri)
+    return blob is not None and key == layout_key(blob) and storage.backend().exists(key)
+
+# returns the new uri, or None when there was nothing to move
+def migrate(uri, dry_run=False):
+    store = storage.backend()
+    old_key = storage.key_of(uri)
+    local = os.path.join(current_app.config['UPLOAD_FOLDER'], old_key)
+    if in_layout(uri) or not os.path.isfile(local):
+        return None
+
+    digest, size = blobs.hash_file(local)
+    existing = Blob.query.filter_by(digest=digest).first()
+    if existing is not None and existing.uri != uri and storage.key_of(existing.uri) != layout_key(existing):
+        # the same content is stored under another old uri: move that one first, then join it
+        migrate(existing.uri, dry_run)
+        existing = Blob.query.filter_by(digest=digest).first()
+    key = layout_key(existing) if existing else storage.blob_key(digest, blobs.extension(uri))
+    new_uri = storage.uri_of(key)
+    if dry_run:
+        return new_uri
+    if not store.exists(key):
+        store.put(key, local)
+
+    try:
+        blob = Blob.query.filter_by(uri=uri).first()
+        if blob is not None and blob.digest == digest: # a blob of the flat layout, same references
+            blob.uri = new_uri
+        else:
+            refs = db.session.query(Video.id).filter(Video.source == uri).count() + \
+                db.session.query(Video_Format.id).filter(Video_Format.uri == uri).count()
+            upsert = sqlite_insert(Blob).values(digest=digest, uri=new_uri, size=size, refs=refs, created_at=datetime.utcnow())
+            upsert = upsert.on_conflict_do_update(index_elements=['digest'], set_={'refs': Blob.refs + refs})
+            db.session.execute(upsert)
+        videos = Video.query.filter(Video.source == uri).all()
+        videos += Video.query.join(Video_Format).filter(Video_Format.uri == uri).all()
+        tags = {tag for video in videos for tag in response_cache.video_tags(video)}
+        Video.query.filter(Video.source == uri).update({'source': new_uri}, synchronize_session=False)
+        Video_Format.query.filter(Video_Format.uri == uri).update({'uri': new_uri}, synchronize_session=False)
+        if not store.exists(key): # collected while we were copying, the write lock is ours now
+            store.put(key, local)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.remove()
+
+    response_cache.invalidate(*tags)
+    return new_uri
+
+def run(dry_run=False, limit=None, grace=0, log=print):
+    moved = []
+    seen = set()
+    for uri in stored_uris():
+        if limit is not None and len(moved) >= limit:
+            break
+        if uri in seen:
+            continue
+        seen.add(uri)
+        new_uri = migrate(uri, dry_run)
+        db.session.remove()
+        if new_uri is not None:
+            moved.append((uri, new_uri))
+            log('%s -> %s' % (uri, new_uri))
+
+    if not dry_run and moved:
+        time.sleep(grace)
+        for old, new in moved:
+            if storage.backend().name != 'local' or storage.key_of(old) != storage.key_of(new):
+                blobs.discard(os.path.join(current_app.config['UPLOAD_FOLDER'], storage.key_of(old)))
+    return moved
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='move stored files into the current storage layout and backend')
+    parser.add_argument('--dry-run', action='store_true', help='list the moves, change nothing')
+    parser.add_argument('--limit', type=int, default=None, help='stop after N files')
+    parser.add_argument('--grace', type=float, default=None, help='seconds before old files are deleted (default: RESPONSE_CACHE_TTL)')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        moved = run(args.dry_run, args.limit, app.config['RESPONSE_CACHE_TTL'] if args.grace is None else args.grace)
+    print('%s %d files' % ('would move' if args.dry_run else 'moved', len(moved)))
@@ -0,0 +1,216 @@
+##
+## FILE WHERE WE DEFINE THE VERSIONED SCHEMA MIGRATIONS
+## each migration runs once and is recorded in schema_version, statements are
+## idempotent (IF NOT EXISTS...) so a migration interrupted midway can be re-run
+## run with `python migrations.py` or let run.py apply them on start
+##
+
+from sqlalchemy import text
+from datetime import datetime
+
+from app import create_app, db
+
+# statement for columns added after a release, ALTER TABLE ADD COLUMN has no IF NOT EXISTS
+def add_column(table, column, ddl):
+    def statement(conn):
+        columns = [row[1] for row in conn.execute(text('PRAGMA table_info(%s)' % table))]
+        if column not in columns:
+            conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, ddl)))
+    return statement
+
+# (version, description, statements), append only: never edit a released migration
+MIGRATIONS = [
+    (1, 'initial schema', [
+        """CREATE TABLE IF NOT EXISTS user (
+            id INTEGER NOT NULL,
+            username VARCHAR(100) NOT NULL,
+            email VARCHAR(100) NOT NULL,
+            pseudo VARCHAR(100),
+            password VARCHAR(255) NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (username),
+            UNIQUE (email)
+        )""",
+        """CREATE TABLE IF NOT EXISTS video (
+            id INTEGER NOT NULL,
+            source VARCHAR(100) NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            "view" INTEGER,
+            enabled BOOLEAN,
+            user_id INTEGER NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS token (
+            id INTEGER NOT NULL,
+            code VARCHAR(255) NOT NULL,
+            expired_at DATETIME,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS video__format (
+            id INTEGER NOT NULL,
+            code VARCHAR(100) NOT NULL,
+            uri VARCHAR(100) NOT NULL,
+            video_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(video_id) REFERENCES video (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS comment (
+            id INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            video_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(video_id) REFERENCES video (id)
+        )""",
+    ]),
+    (2, 'secondary indexes and unique video format code', [
+        'CREATE INDEX IF NOT EXISTS ix_video_user_id ON video (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_video_created_at_id ON video (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_comment_video_id ON comment (video_id)',
+        'CREATE INDEX IF NOT EXISTS ix_comment_user_id ON comment (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_token_user_id ON token (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_user_pseudo ON user (pseudo)',
+        'CREATE INDEX IF NOT EXISTS ix_user_created_at_id ON user (created_at, id)',
+        # keep the latest uri of duplicated formats before enforcing uniqueness
+        'DELETE FROM video__format WHERE id NOT IN (SELECT MAX(id) FROM video__format GROUP BY video_id, code)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_video__format_video_id_code ON video__format (video_id, code)',
+    ]),
+    (3, 'resumable upload sessions', [
+        """CREATE TABLE IF NOT EXISTS upload (
+            id VARCHAR(32) NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            name VARCHAR(100),
+            size BIGINT NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""",
+        'CREATE INDEX IF NOT EXISTS ix_upload_user_id ON upload (user_id)',
+        """CREATE TABLE IF NOT EXISTS upload__chunk (
+            id INTEGER NOT NULL,
+            upload_id VARCHAR(32) NOT NULL,
+            start BIGINT NOT NULL,
+            "end" BIGINT NOT NULL,
+            sha256 VARCHAR(64) NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(upload_id) REFERENCES upload (id)
+        )""",
+        'CREATE INDEX IF NOT EXISTS ix_upload__chunk_upload_id ON upload__chunk (upload_id)',
+    ]),
+    (4, 'server-side encoding jobs', [
+        """CREATE TABLE IF NOT EXISTS encoding__job (
+            id INTEGER NOT NULL,
+            code VARCHAR(100) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            progress INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            video_id INTEGER NOT NULL,
+            created_at DATETIME,
+            updated_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(video_id) REFERENCES video (id)
+        )""",
+        'CREATE INDEX IF NOT EXISTS ix_encoding__job_status ON encoding__job (status)',
+        'CREATE INDEX IF NOT EXISTS ix_encoding__job_video_id ON encoding__job (video_id)',
+    ]),
+    (5, 'file to video lookups for the view counter', [
+        'CREATE INDEX IF NOT EXISTS ix_video_source ON video (source)',
+        'CREATE INDEX IF NOT EXISTS ix_video__format_uri ON video__format (uri)',
+    ]),
+    (6, 'token store: hashed codes, expiry and revocation', [
+        add_column('token', 'revoked_at', 'DATETIME'),
+        # rows written before this version hold the raw token, nothing can match them by hash
+        "DELETE FROM token WHERE length(code) != 64",
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_token_code ON token (code)',
+        'CREATE INDEX IF NOT EXISTS ix_token_expired_at ON token (expired_at)',
+        'CREATE INDEX IF NOT EXISTS ix_token_revoked_at ON token (revoked_at)',
+    ]),
+    (7, 'content-addressed upload storage', [
+        """CREATE TABLE IF NOT EXISTS blob (
+            digest VARCHAR(64) NOT NULL,
+            uri VARCHAR(100) NOT NULL,
+            size BIGINT NOT NULL,
+            refs INTEGER NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (digest),
+            UNIQUE (uri)
+        )""",
+    ]),
+    (8, 'denormalized comment and format counters on video', [
+        add_column('video', 'comment_count', "INTEGER NOT NULL DEFAULT '0'"),
+        add_column('video', 'format_count', "INTEGER NOT NULL DEFAULT '0'"),
+        'UPDATE video SET comment_count = (SELECT COUNT(*) FROM comment WHERE comment.video_id = video.id), '
+        'format_count = (SELECT COUNT(*) FROM video__format WHERE video__format.video_id = video.id)',
+        'CREATE INDEX IF NOT EXISTS ix_video_comment_count_id ON video (comment_count, id)',
+    ]),
+    (9, 'background deletion of videos and users', [
+        add_column('user', 'enabled', "BOOLEAN NOT NULL DEFAULT '1'"),
+        'UPDATE video SET enabled = 1 WHERE enabled IS NULL',
+        """CREATE TABLE IF NOT EXISTS deletion (
+            id INTEGER NOT NULL,
+            kind VARCHAR(20) NOT NULL,
+            target_id INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            created_at DATETIME,
+            updated_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        'CREATE INDEX IF NOT EXISTS ix_deletion_status ON deletion (status)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_deletion_kind_target_id ON deletion (kind, target_id)',
+    ]),
+    (10, 'leases on running encoding jobs', [
+        add_column('encoding__job', 'lease_until', 'DATETIME'),
+    ]),
+    (11, 'leases on running deletions', [
+        add_column('deletion', 'lease_until', 'DATETIME'),
+    ]),
+    (12, 'upload session status and expiry', [
+        add_column('upload', 'status', "VARCHAR(20) NOT NULL DEFAULT 'open'"),
+        add_column('upload', 'updated_at', 'DATETIME'),
+        'UPDATE upload SET updated_at = created_at WHERE updated_at IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_upload_updated_at ON upload (updated_at)',
+    ]),
+]
+
+def current_version(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL PRIMARY KEY, description VARCHAR(255), applied_at DATETIME)'
+    ))
+    return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+# apply every pending migration, returns the list of versions applied
+def upgrade():
+    applied = []
+    with db.engine.begin() as conn:
+        version = current_version(conn)
+
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        with db.engine.begin() as conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            conn.execute(
+                text('INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :applied_at)'),
+                {'version': number, 'description': description, 'applied_at': datetime.utcnow()}
+            )
+        applied.append(number)
+    return applied
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        applied = upgrade()
+    print('applied migrations: %s' % (applied or 'none, schema is up to date'))
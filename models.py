@@ -14,40 +14,106 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
-    pseudo = db.Column(db.String(100), nullable=True)
+    pseudo = db.Column(db.String(100), nullable=True, index=True)
     password = db.Column(db.String(255), nullable=False)
     videos = db.relationship('Video', backref='user', lazy='dynamic')
     comments = db.relationship('Comment', backref='user', lazy='dynamic')
+    enabled = db.Column(db.Boolean, nullable=False, default=True, server_default='1') # off while deleted (see services/removal.py)
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    __table_args__ = (db.Index('ix_user_created_at_id', 'created_at', 'id'),) # keyset pagination
 
 class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    source = db.Column(db.String(100), nullable=False)
+    source = db.Column(db.String(100), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     view = db.Column(db.Integer, default=0)
-    enabled = db.Column(db.Boolean, default=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    enabled = db.Column(db.Boolean, default=True) # off while deleted (see services/removal.py)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     formats = db.relationship('Video_Format', backref='video', lazy='dynamic')
     comments = db.relationship('Comment', backref='video', lazy='dynamic')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see services/counters.py
+    format_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    __table_args__ = (
+        db.Index('ix_video_created_at_id', 'created_at', 'id'), # keyset pagination
+        db.Index('ix_video_comment_count_id', 'comment_count', 'id'), # most discussed
+    )
 
 class Video_Format(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(100), nullable=False)
-    uri = db.Column(db.String(100), nullable=False)
+    uri = db.Column(db.String(100), nullable=False, index=True)
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    __table_args__ = (db.Index('uq_video__format_video_id_code', 'video_id', 'code', unique=True),) # one uri per format
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
 
+# issued tokens (see services/sessions.py), code is the sha256 of the token, never the token itself
 class Token(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(255), nullable=False)
-    expired_at = db.Column(db.DateTime, default=datetime.utcnow())
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    expired_at = db.Column(db.DateTime, default=datetime.utcnow(), index=True)
+    revoked_at = db.Column(db.DateTime, nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    __table_args__ = (db.Index('uq_token_code', 'code', unique=True),) # lookups by hash
+
+# resumable chunked upload session (see routes/uploads.py)
+class Upload(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    filename = db.Column(db.String(255), nullable=False)
+    name = db.Column(db.String(100), nullable=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    chunks = db.relationship('Upload_Chunk', backref='upload', lazy='dynamic')
+    status = db.Column(db.String(20), nullable=False, default='open') # open, finalizing
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True) # last write, idle sessions expire
+
+class Upload_Chunk(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload.id'), nullable=False, index=True)
+    start = db.Column(db.BigInteger, nullable=False)
+    end = db.Column(db.BigInteger, nullable=False) # inclusive, like Content-Range
+    sha256 = db.Column(db.String(64), nullable=False)
+
+# server-side encoding of a video into one format (see services/encoding.py)
+class Encoding_Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, done, dead
+    progress = db.Column(db.Integer, nullable=False, default=0) # percent
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
+    lease_until = db.Column(db.DateTime, nullable=True) # renewed while running, past it the job is taken over
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# uploaded file stored once under its sha256, refs counts the Video.source and
+# Video_Format.uri pointing at uri (see services/blobs.py)
+class Blob(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)
+    uri = db.Column(db.String(100), nullable=False, unique=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# video or user being deleted in the background (see services/removal.py)
+class Deletion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False) # video, user
+    target_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued, running, dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    lease_until = db.Column(db.DateTime, nullable=True) # renewed while running, past it the deletion is taken over
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('uq_deletion_kind_target_id', 'kind', 'target_id', unique=True),)
 
 #################
 #### SCHEMAS ####
@@ -63,18 +129,41 @@ class CommentSchema(ma.SQLAlchemyAutoSchema):
         model = Comment
         load_instance=True
 
+# comment with its user and video ids, for the exports (see routes/exports.py)
+class CommentRowSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Comment
+        include_fk = True
+
 class VideoFormatSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Video_Format
         load_instance=True
 
+# comments are not embedded, comment_count says how many /video/<id>/comments has
 class VideoSchema(ma.SQLAlchemyAutoSchema):
     formats = ma.Nested(VideoFormatSchema, many=True)
-    comments = ma.Nested(CommentSchema, many=True)
     class Meta:
         model = Video
         load_instance=True
 
+# flat video row used by listings, formats are attached in batch (see services/listing.py)
+class VideoListSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Video
+
+class UploadSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Upload
+        load_instance=True
+
+class EncodingJobSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Encoding_Job
+        include_fk = True
+        load_instance=True
+        exclude = ('lease_until',)
+
 class UserSchema(ma.SQLAlchemyAutoSchema):
     videos = ma.Nested(VideoSchema, many=True)
     class Meta:
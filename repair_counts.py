@@ -0,0 +1,14 @@
+##
+## FILE WHERE WE REPAIR THE DENORMALIZED COUNTERS
+## recomputes Video.comment_count and Video.format_count from the comment and
+## video__format tables, in batches, while the server keeps running
+## run with `python repair_counts.py`
+##
+
+from app import create_app
+from services import counters
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        fixed = counters.repair()
+    print('repaired counters of %d videos' % fixed)
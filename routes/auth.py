@@ -1,14 +1,51 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, request
 from sqlalchemy import exc
 from functools import wraps
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 import jwt
 import re
+import time
+import uuid
 
 # personal imports
-from models import User, UserSchema, Token
-from app import app, db, flask_bcrypt
+from models import User, UserSchema
+from app import db
+from services.serialization import jsonify
+from services.cache import TTLCache
+from services import hashing, sessions
+
+# verified tokens -> lightweight principal, so steady-state auth skips jwt.decode and the user query.
+# entries never outlive the token's exp and are dropped by modifyUser/deleteUser (per process,
+# other workers catch up after TOKEN_CACHE_TTL at most)
+TOKEN_CACHE_TTL = 60
+Principal = namedtuple('Principal', ['id', 'username', 'email', 'pseudo'])
+_tokens = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+
+# returns the principal of a token, None if its user is gone, raises if the token is invalid or revoked
+def resolve_token(token):
+    if sessions.is_revoked(token):
+        raise sessions.TokenRevoked()
+
+    principal = _tokens.get(token)
+    if principal is not None:
+        return principal
+
+    decoded = jwt.decode(token, current_app.config['SECRET_KEY'])
+    user = User.query.filter_by(id = decoded['id'], enabled = True).first()
+    if user is None:
+        return None
+
+    principal = Principal(user.id, user.username, user.email, user.pseudo)
+    ttl = min(TOKEN_CACHE_TTL, decoded['exp'] - time.time()) if 'exp' in decoded else TOKEN_CACHE_TTL
+    if ttl > 0:
+        _tokens.set(token, principal, ttl=ttl)
+    return principal
+
+# forget every cached token of a user, call when the user is modified or deleted
+def invalidate_user(userId):
+    _tokens.delete_where(lambda token, principal: principal.id == userId)
 
 # token decorators
 # 1st blocks workflow and return error if no token of wrong token
@@ -16,15 +53,17 @@ def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = request.headers.get('x-token')
-        print(jwt.decode(token, verify=False))
         if token is None:
             return jsonify({
                 'message': 'Unauthorized',
             }), 401
 
         try: 
-            decoded = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user = User.query.filter_by(id = decoded['id']).first()
+            current_user = resolve_token(token)
+        except sessions.StoreUnavailable as err:
+            return jsonify({
+                'message': 'Service unavailable',
+            }), 503, {'Retry-After': str(err.retry_after)}
         except:
             return jsonify({
                 'message': 'Unauthorized',
@@ -45,8 +84,11 @@ def token_optional(f):
             return f(current_user, *args, **kwargs)
 
         try: 
-            data = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user = User.query.filter_by(id = data['id']).first()
+            current_user = resolve_token(token)
+        except sessions.StoreUnavailable as err:
+            return jsonify({
+                'message': 'Service unavailable',
+            }), 503, {'Retry-After': str(err.retry_after)}
         except:
             return jsonify({
                 'message': 'Unauthorized',
@@ -81,26 +123,36 @@ def auth():
         }), 400
 
     if pattern.fullmatch(login):
-        user = User.query.filter_by(username = login).first()
+        user = User.query.filter_by(username = login, enabled = True).first()
     else:
-        user = User.query.filter_by(email = login).first()
+        user = User.query.filter_by(email = login, enabled = True).first()
 
     if not user:
         return jsonify({
             'message': 'Not found',
         }), 404
 
-    if flask_bcrypt.check_password_hash(user.password, password):
+    try:
+        matches = hashing.check_password(user.password, password)
+    except hashing.HashingBusy as err:
+        return jsonify({
+            'message': 'Service unavailable',
+        }), 503, {'Retry-After': str(err.retry_after)}
+
+    if matches:
+        # the configured cost factor changed since this hash was made, upgrade it while we know the password
+        if hashing.needs_rehash(user.password):
+            try:
+                user.password = hashing.hash_password(password)
+            except hashing.HashingBusy:
+                pass # try again on the next login
+
         expired_date = datetime.utcnow() + timedelta(minutes=60)
-        token = jwt.encode({'id': user.id, 'exp': expired_date}, app.config['SECRET_KEY'])
+        # jti: two logins in the same second still get distinct tokens (and rows in the store)
+        token = jwt.encode({'id': user.id, 'exp': expired_date, 'jti': uuid.uuid4().hex}, current_app.config['SECRET_KEY'])
 
         try:
-            newToken = Token(
-                code = token,
-                expired_at = expired_date,
-                user_id = user.id
-            )
-            db.session.add(newToken)
+            sessions.create(token, user.id, expired_date)
             db.session.commit()
         except exc.IntegrityError as err:
             db.session.rollback()
@@ -125,3 +177,31 @@ def auth():
             'code': 10010, # password doesn't match
             'data': ''
         }), 400
+
+# logout: revoke the token of the request, or every token of its user with ?all=1
+@auth_api.route('/auth', methods=['DELETE'])
+@token_required
+def logout(current_user):
+    token = request.headers.get('x-token')
+
+    if current_user is None:
+        return jsonify({
+            'message': 'Unauthorized',
+        }), 401
+
+    try:
+        if request.args.get('all') == '1':
+            sessions.revoke_user(current_user.id)
+        else:
+            expired_at = datetime.utcfromtimestamp(jwt.decode(token, current_app.config['SECRET_KEY'])['exp'])
+            sessions.revoke(token, expired_at)
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    _tokens.delete(token)
+
+    return jsonify({}), 204
@@ -0,0 +1,118 @@
+from flask import Blueprint, Response, request, stream_with_context
+import csv
+import io
+import re
+
+# personal imports
+from models import User, UserSchema, Video, VideoListSchema, Comment, CommentRowSchema
+from app import db
+from services.serialization import jsonify, dump, dumps_line
+from services.fields import parse as parse_fields, InvalidFields
+from routes.users import PUBLIC_FIELDS
+from routes.videos import VIDEO_FIELDS
+
+# streamed exports, for the analytics jobs:
+#   GET /export/videos      ?user_id=
+#   GET /export/users
+#   GET /export/comments    ?video_id= ?user_id=
+# every route takes ?format=ndjson (default) or csv, ?fields= and ?after=<id>, the ids
+# (?after, ?user_id, ?video_id) are decimal digits or the request is a 400. rows come
+# in id order, BATCH_SIZE per query (keyset on the primary key, no OFFSET, no transaction
+# held between two batches), so memory stays flat whatever the size of the table and a
+# client that lost the connection resumes with ?after=<last id it saw>. id is always sent
+
+BATCH_SIZE = 1000
+COMMENT_FIELDS = ('id', 'body', 'user_id', 'video_id')
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+exports_api = Blueprint('exports_api', __name__)
+
+# batches of rows (named tuples of the columns of fields) with an id greater than after,
+# joins are (model, onclause) the criteria need
+def batches(model, fields, criteria, joins, after):
+    columns = [getattr(model, name) for name in fields]
+    while True:
+        query = db.session.query(*columns)
+        for target, onclause in joins:
+            query = query.join(target, onclause)
+        rows = query.filter(model.id > after, *criteria).order_by(model.id).limit(BATCH_SIZE).all()
+        db.session.close() # the next batch sees the writes made in between
+        if not rows:
+            return
+        yield rows
+        after = rows[-1].id
+
+def encode_csv(fields, items):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for item in items:
+        writer.writerow(['' if item[name] is None else item[name] for name in fields])
+    return out.getvalue().encode('utf-8')
+
+# filters are the optional id parameters of the route, {'user_id': Video.user_id}
+def export(model, schema, allowed, criteria, joins=(), filters=None):
+    filters = filters or {}
+    query_params = request.args
+    format = query_params.get('format', 'ndjson')
+    after = query_params.get('after', '0')
+    ids = {name: query_params.get(name) for name in filters if query_params.get(name) is not None}
+
+    try:
+        fields = parse_fields(query_params.get('fields'), allowed) or allowed
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
+
+    if format not in MIMETYPES or not all(re.fullmatch(r'[0-9]+', value) for value in [after, *ids.values()]):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
+    after = int(after) # before the response starts, an error in the stream would truncate it
+    criteria = list(criteria) + [filters[name] == int(value) for name, value in ids.items()]
+
+    if 'id' not in fields:
+        fields = ('id',) + fields # the resume point
+
+    def generate():
+        if format == 'csv':
+            yield encode_csv(fields, [{name: name for name in fields}])
+        for rows in batches(model, fields, criteria, joins, after):
+            items = dump(schema, rows, only=fields, many=True)
+            if format == 'csv':
+                yield encode_csv(fields, items)
+            else:
+                yield b''.join(dumps_line(item) for item in items)
+
+    response = Response(stream_with_context(generate()), mimetype=MIMETYPES[format])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+#######################################
+### STARTING TO DEFINE ROUTES HERE ####
+#######################################
+
+# export videos
+@exports_api.route('/export/videos', methods=['GET'])
+def exportVideos():
+    return export(Video, VideoListSchema, VIDEO_FIELDS, [Video.enabled == True], filters={'user_id': Video.user_id})
+
+# export users, public fields only
+@exports_api.route('/export/users', methods=['GET'])
+def exportUsers():
+    return export(User, UserSchema, PUBLIC_FIELDS, [User.enabled == True])
+
+# export comments, of the videos and users not deleted
+@exports_api.route('/export/comments', methods=['GET'])
+def exportComments():
+    joins = [(Video, Video.id == Comment.video_id), (User, User.id == Comment.user_id)]
+    criteria = [Video.enabled == True, User.enabled == True]
+    filters = {'video_id': Comment.video_id, 'user_id': Comment.user_id}
+    return export(Comment, CommentRowSchema, COMMENT_FIELDS, criteria, joins, filters)
@@ -0,0 +1,43 @@
+from flask import Blueprint, current_app, request
+import hmac
+
+# personal imports
+from services.serialization import jsonify
+from services import metrics
+
+# monitoring:
+#   GET /metrics               Prometheus text format, per process
+#   GET /metrics/slow-queries  latest statements slower than METRICS_SLOW_QUERY
+# when METRICS_TOKEN is set both need 'Authorization: Bearer <METRICS_TOKEN>'
+
+def authorized():
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        return True
+    return hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+
+#######################################
+### STARTING TO DEFINE ROUTES HERE ####
+#######################################
+metrics_api = Blueprint('metrics_api', __name__)
+
+@metrics_api.route('/metrics', methods=['GET'])
+def getMetrics():
+    if not authorized():
+        return jsonify({
+            'message': 'Unauthorized',
+        }), 401
+
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics_api.route('/metrics/slow-queries', methods=['GET'])
+def getSlowQueries():
+    if not authorized():
+        return jsonify({
+            'message': 'Unauthorized',
+        }), 401
+
+    return jsonify({
+        'message': 'OK',
+        'data': metrics.slow_queries()
+    }), 200
@@ -0,0 +1,338 @@
+from flask import Blueprint, current_app, request
+from werkzeug.utils import secure_filename
+from sqlalchemy import exc
+from datetime import datetime
+import hashlib
+import os
+import re
+import uuid
+
+# personal imports
+from models import Video, VideoSchema, Upload, Upload_Chunk, UploadSchema
+from app import db
+from services.serialization import jsonify, dump
+from routes.auth import token_required
+from services import blobs, removal, search, response_cache
+from services.blobs import partial_path
+from services.media import is_video
+
+# resumable chunked uploads:
+#   POST   /user/<id>/upload      create a session {filename, size, name}
+#   PUT    /upload/<uploadId>     write a byte range (Content-Range: bytes start-end/size), in any order
+#   GET    /upload/<uploadId>     session status and received ranges
+#   POST   /upload/<uploadId>     finalize into a Video once every byte is there
+#   DELETE /upload/<uploadId>     abort
+# chunks are streamed straight into a preallocated file, memory per upload stays constant.
+# a session being finalized takes no more writes, sessions idle for UPLOAD_EXPIRY are
+# dropped by the deletion worker (see services/removal.py)
+
+BLOCK_SIZE = 64 * 1024
+content_range_pattern = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# merge the received chunks into sorted, non overlapping [start, end] ranges
+def received_ranges(upload):
+    ranges = []
+    for chunk in upload.chunks.order_by(Upload_Chunk.start):
+        if ranges and chunk.start <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], chunk.end)
+        else:
+            ranges.append([chunk.start, chunk.end])
+    return ranges
+
+def upload_output(upload):
+    output = dump(UploadSchema, upload)
+    output['ranges'] = received_ranges(upload)
+    output['chunk_size'] = current_app.config['UPLOAD_CHUNK_SIZE']
+    return output
+
+# session lookup + ownership check shared by the /upload/<uploadId> routes
+def owned_upload(current_user, uploadId):
+    upload = Upload.query.filter_by(id=uploadId).first()
+    if not upload:
+        return None, (jsonify({
+            'message': 'Upload not found',
+        }), 404)
+    if current_user is None or current_user.id != upload.user_id:
+        return None, (jsonify({
+            'message': 'Forbidden',
+        }), 403)
+    return upload, None
+
+def discard(upload):
+    path = removal.delete_upload(upload)
+    db.session.commit()
+    blobs.discard(path)
+
+def finalizing():
+    return jsonify({
+        'message': 'Conflict',
+        'code': 10025, # upload is being finalized
+        'data': ''
+    }), 409
+
+# a session is finalized by one request at a time, the others get False
+def lock(upload):
+    locked = Upload.query.filter_by(id=upload.id, status='open').update({
+        'status': 'finalizing',
+        'updated_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    return bool(locked)
+
+def unlock(upload):
+    Upload.query.filter_by(id=upload.id, status='finalizing').update({'status': 'open'}, synchronize_session=False)
+    db.session.commit()
+
+#######################################
+### STARTING TO DEFINE ROUTES HERE ####
+#######################################
+uploads_api = Blueprint('uploads_api', __name__)
+
+# create an upload session
+@uploads_api.route('/user/<int:userId>/upload', methods=['POST'])
+@token_required
+def createUpload(current_user, userId):
+    if (current_user is None or current_user.id != userId):
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+
+    data = request.get_json() or request.form
+    filename = data.get('filename')
+    name = data.get('name')
+    size = data.get('size', type=int) if hasattr(data, 'getlist') else data.get('size')
+
+    if (
+        filename is None or type(filename) is not str or secure_filename(filename) == '' or
+        name is not None and type(name) is not str or
+        type(size) is not int or size < 1 or size > current_app.config['MAX_UPLOAD_SIZE']
+        ):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
+
+    try:
+        newUpload = Upload(
+            id = uuid.uuid4().hex,
+            filename = secure_filename(filename),
+            name = name,
+            size = size,
+            user_id = current_user.id,
+            created_at = datetime.utcnow(),
+            updated_at = datetime.utcnow()
+        )
+        os.makedirs(os.path.dirname(partial_path(newUpload)), exist_ok=True)
+        with open(partial_path(newUpload), 'wb') as partial:
+            partial.truncate(size) # sparse file, chunks can land in any order
+        db.session.add(newUpload)
+        db.session.commit()
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    return jsonify({
+        'message': 'OK',
+        'data': upload_output(newUpload)
+    }), 201
+
+# upload status
+@uploads_api.route('/upload/<uploadId>', methods=['GET'])
+@token_required
+def getUpload(current_user, uploadId):
+    upload, error = owned_upload(current_user, uploadId)
+    if error:
+        return error
+
+    return jsonify({
+        'message': 'OK',
+        'data': upload_output(upload)
+    }), 200
+
+# write one chunk
+@uploads_api.route('/upload/<uploadId>', methods=['PUT'])
+@token_required
+def putUploadChunk(current_user, uploadId):
+    upload, error = owned_upload(current_user, uploadId)
+    if error:
+        return error
+
+    if upload.status != 'open':
+        return finalizing()
+
+    match = content_range_pattern.match(request.headers.get('Content-Range', ''))
+    if match:
+        start, end, total = (int(g) for g in match.groups())
+    if not match or start > end or total != upload.size or end >= upload.size:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10022, # missing or invalid Content-Range
+            'data': ''
+        }), 400
+
+    expected = end - start + 1
+    digest = hashlib.sha256()
+    written = 0
+    with open(partial_path(upload), 'r+b') as partial:
+        partial.seek(start)
+        while written < expected:
+            block = request.stream.read(min(BLOCK_SIZE, expected - written))
+            if not block:
+                break
+            if start == 0 and written == 0 and not is_video(block):
+                return jsonify({
+                    'message': 'Bad request',
+                    'code': 10021, # wrong file type
+                    'data': ''
+                }), 400
+            partial.write(block)
+            digest.update(block)
+            written += len(block)
+
+    if written != expected or request.stream.read(1):
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10022, # body doesn't match Content-Range
+            'data': ''
+        }), 400
+
+    checksum = request.headers.get('X-Chunk-Sha256')
+    if checksum is not None and checksum.lower() != digest.hexdigest():
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10023, # checksum mismatch
+            'data': ''
+        }), 400
+
+    try:
+        db.session.add(Upload_Chunk(upload_id = upload.id, start = start, end = end, sha256 = digest.hexdigest()))
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    return jsonify({
+        'message': 'OK',
+        'data': {
+            'start': start,
+            'end': end,
+            'sha256': digest.hexdigest()
+        }
+    }), 200
+
+# finalize into a video
+@uploads_api.route('/upload/<uploadId>', methods=['POST'])
+@token_required
+def finalizeUpload(current_user, uploadId):
+    upload, error = owned_upload(current_user, uploadId)
+    if error:
+        return error
+
+    if not lock(upload):
+        return finalizing()
+    try:
+        return finalize(upload)
+    except Exception:
+        db.session.rollback()
+        unlock(upload)
+        raise
+
+# the session is locked, it is unlocked again unless the video is committed
+def finalize(upload):
+    if received_ranges(upload) != [[0, upload.size - 1]]:
+        unlock(upload)
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10024, # upload incomplete
+            'data': upload_output(upload)
+        }), 400
+
+    # whole file digest, streamed from disk. the type is checked again on the assembled
+    # head: a later chunk may have rewritten the bytes sniffed when chunk 0 came in
+    digest = hashlib.sha256()
+    with open(partial_path(upload), 'rb') as partial:
+        head = partial.read(1024)
+        partial.seek(0)
+        for block in iter(lambda: partial.read(BLOCK_SIZE), b''):
+            digest.update(block)
+
+    if not is_video(head):
+        unlock(upload)
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10021, # wrong file type
+            'data': ''
+        }), 400
+
+    data = request.get_json(silent=True) or request.form
+    checksum = data.get('sha256')
+    if checksum is not None and str(checksum).lower() != digest.hexdigest():
+        unlock(upload)
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10023, # checksum mismatch
+            'data': ''
+        }), 400
+
+    ## save to db, the assembled file becomes (or joins) the blob of its digest. the
+    ## partial file is kept until the commit, a failed finalize can be retried
+    path = partial_path(upload)
+    try:
+        newVideo = Video(
+            name = upload.name or upload.filename,
+            source = blobs.acquire(path, digest.hexdigest(), upload.size, blobs.extension(upload.filename), keep=True),
+            user_id = upload.user_id,
+            created_at = datetime.utcnow()
+        )
+        db.session.add(newVideo)
+        search.index(newVideo)
+        Upload_Chunk.query.filter_by(upload_id=upload.id).delete()
+        db.session.delete(upload)
+        db.session.commit()
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        unlock(upload)
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        unlock(upload)
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    blobs.discard(path)
+    response_cache.invalidate(*response_cache.video_tags(newVideo))
+
+    output = dump(VideoSchema, newVideo)
+    output['sha256'] = digest.hexdigest()
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 201
+
+# abort an upload
+@uploads_api.route('/upload/<uploadId>', methods=['DELETE'])
+@token_required
+def deleteUpload(current_user, uploadId):
+    upload, error = owned_upload(current_user, uploadId)
+    if error:
+        return error
+
+    if not lock(upload): # neither finalized nor written from here
+        return finalizing()
+    discard(upload)
+
+    return jsonify({}), 204
@@ -1,66 +1,134 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 from sqlalchemy import exc
 from datetime import datetime, timedelta
 import re
 
 # personal imports
 from models import User, UserSchema, Video, VideoSchema
-from app import db, flask_bcrypt
-from routes.auth import token_optional, token_required
+from app import db
+from services.serialization import jsonify, dump
+from routes.auth import token_optional, token_required, invalidate_user
+from services.pagination import paginate, InvalidCursor
+from services.batch import parse_ids, missing, InvalidBatch
+from services.fields import fieldset, columns, InvalidFields
+from services.listing import dump_videos
+from services import removal, search, response_cache
+from services.response_cache import cached
+from services.hashing import hash_password, HashingBusy
 
 users_api = Blueprint('users_api', __name__)
 
+# ?fields= of the user routes, the password hash is never served
+PUBLIC_FIELDS = ('id', 'username', 'pseudo', 'created_at')
+OWNER_FIELDS = ('id', 'username', 'pseudo', 'email', 'created_at')
+
 # get all users
 @users_api.route('/users', methods=['GET'])
+@cached(lambda: ['users'])
 def getUsers():
     query_params = request.args
     pseudo = query_params.get('pseudo', None, type=str)
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    q = query_params.get('q', None, type=str)
+
+    try:
+        fields, include = fieldset(query_params, PUBLIC_FIELDS)
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
+    only = fields or PUBLIC_FIELDS
+    options = columns(User, only, ('id', 'created_at'))
+
+    if q:
+        users, pager = search.search(User, q, query_params, options)
+        return jsonify({
+            'message': 'OK',
+            'data': dump(UserSchema, users, only=only, many=True),
+            'pager': pager
+        })
 
     if pseudo:
-        paginate = User.query.filter_by(pseudo = pseudo).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
+        query = User.query.options(*options).filter_by(pseudo = pseudo, enabled = True)
     else:
-        paginate = User.query.paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    users = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+        query = User.query.options(*options).filter_by(enabled = True)
+
+    try:
+        users, pager = paginate(query, (User.created_at, User.id), query_params)
+    except InvalidCursor:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
+
+    output = dump(UserSchema, users, only=only, many=True)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output,
+        'pager': pager
+    })
+
+# get several users at once, ?ids=1,2,3 (public fields only)
+@users_api.route('/users/batch', methods=['GET'])
+@cached(lambda: ['users'])
+def getUsersBatch():
+    try:
+        ids = parse_ids(request.args.get('ids'))
+    except InvalidBatch:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
 
-    if not users:
-        users = [] # possible options here: return empty array, or return 404 not found ? not sure
+    try:
+        fields, include = fieldset(request.args, PUBLIC_FIELDS)
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
+    only = fields or PUBLIC_FIELDS
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'created_at'), many=True)
-    output = schema.dump(users)
+    users = {user.id: user for user in User.query.options(*columns(User, only, ('id',))).filter(User.id.in_(ids), User.enabled == True)}
+    output = dump(UserSchema, [users[userId] for userId in ids if userId in users], only=only, many=True)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'errors': missing(ids, users, 'Not found')
     })
 
 # get one user
 @users_api.route('/user/<int:userId>', methods=['GET'])
+@cached(lambda userId: ['user:%d' % userId, 'user:%d:videos' % userId])
 @token_optional
 def getUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    allowed = OWNER_FIELDS if current_user is not None and current_user.id == userId else PUBLIC_FIELDS
+    try:
+        fields, include = fieldset(request.args, allowed, ('videos',))
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
+    only = fields or allowed
+
+    user = User.query.options(*columns(User, only, ('id',))).filter_by(id=userId, enabled=True).first()
 
     if not user:
         return jsonify({
             'message': 'Not found',
         }), 404
 
-    if current_user is not None and current_user.id == user.id:
-        schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at', 'password', 'videos'))
-    else :
-        schema = UserSchema(only=('id', 'username', 'pseudo', 'created_at'))
-
-    output = schema.dump(user)
-    # video_schema = VideoSchema(many=True)
-    # videos = Video.query.filter_by(user_id=userId).all()
-    # output['videos'] = video_schema.dump(videos).data
+    output = dump(UserSchema, user, only=only)
+    if 'videos' in include: # ?include=videos, one query for the videos and one for their formats
+        output['videos'] = dump_videos(Video.query.filter_by(user_id=userId, enabled=True).order_by(Video.created_at, Video.id).all())
 
     return jsonify({
         'message': 'OK',
@@ -96,17 +164,24 @@ def createUser():
             username = username,
             pseudo = pseudo or username,
             email = email,
-            password = flask_bcrypt.generate_password_hash(password, rounds=10).decode('utf-8'),
+            password = hash_password(password),
             created_at = datetime.utcnow()
         )
         db.session.add(newUser)
+        search.index(newUser)
         db.session.commit()
+        response_cache.invalidate('users')
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
             'message': 'Bad request',
             'data': err.args
         }), 400
+    except HashingBusy as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Service unavailable',
+        }), 503, {'Retry-After': str(err.retry_after)}
     except Exception as err:
         db.session.rollback()
         return jsonify({
@@ -114,8 +189,7 @@ def createUser():
             'data': err.args
         }), 500
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at'))
-    output = schema.dump(newUser)
+    output = dump(UserSchema, newUser, only=('id', 'username', 'pseudo', 'email', 'created_at'))
 
     return jsonify({
         'message': 'OK',
@@ -126,7 +200,7 @@ def createUser():
 @users_api.route('/user/<int:userId>', methods=['DELETE'])
 @token_required
 def deleteUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    user = User.query.filter_by(id=userId, enabled=True).first()
 
     if not user:
         return jsonify({
@@ -138,16 +212,19 @@ def deleteUser(current_user, userId):
             'message': 'Forbidden',
         }), 403
 
-    db.session.delete(user)
-    db.session.commit()
+    removal.delete_user(user) # disabled now, videos, uploads, comments and tokens follow in the background
+    invalidate_user(user.id)
+    response_cache.invalidate('user:%d:videos' % user.id, *response_cache.user_tags(user.id))
 
-    return jsonify({}), 204
+    return jsonify({
+        'message': 'Accepted',
+    }), 202
 
 # modify a user
 @users_api.route('/user/<int:userId>', methods=['PUT'])
 @token_required
 def modifyUser(current_user, userId):
-    user = User.query.filter_by(id=userId).first()
+    user = User.query.filter_by(id=userId, enabled=True).first()
 
     if not user:
         return jsonify({
@@ -184,14 +261,22 @@ def modifyUser(current_user, userId):
         user.username = username #unique
         user.pseudo = pseudo or None
         user.email = email #unique
-        user.password = flask_bcrypt.generate_password_hash(password, rounds=10).decode('utf-8')
+        user.password = hash_password(password)
+        search.index(user)
         db.session.commit()
+        invalidate_user(user.id)
+        response_cache.invalidate(*response_cache.user_tags(user.id))
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
             'message': 'Bad request',
             'data': err.args
         }), 400
+    except HashingBusy as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Service unavailable',
+        }), 503, {'Retry-After': str(err.retry_after)}
     except Exception as err:
         db.session.rollback()
         return jsonify({
@@ -199,8 +284,7 @@ def modifyUser(current_user, userId):
             'data': err.args
         }), 500
 
-    schema = UserSchema(only=('id', 'username', 'pseudo', 'email', 'created_at'))
-    output = schema.dump(user)
+    output = dump(UserSchema, user, only=('id', 'username', 'pseudo', 'email', 'created_at'))
 
     return jsonify({
         'message': 'OK',
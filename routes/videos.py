@@ -1,76 +1,147 @@
-from flask import Blueprint, jsonify, request, send_from_directory
+from flask import Blueprint, request, abort, redirect
 from werkzeug.utils import secure_filename
 from sqlalchemy import exc
+from collections import Counter
 from datetime import datetime, timedelta
-import magic
 import re
 
 # personal imports
-from models import User, UserSchema, Video, Video_Format, VideoSchema, VideoFormatSchema, Comment, CommentSchema
-from app import app, db
+from models import User, UserSchema, Video, Video_Format, VideoSchema, VideoFormatSchema, Comment, CommentSchema, Encoding_Job, EncodingJobSchema
+from app import db
+from services.serialization import jsonify, dump
 from routes.auth import token_optional, token_required
+from services.pagination import paginate, InvalidCursor
+from services.batch import parse_ids, parse_items, missing, InvalidBatch
+from services.fields import fieldset, columns, InvalidFields
+from services.listing import dump_videos
+from services import search
+from services.media import is_video
+from services.delivery import send_upload
+from services import blobs, counters, encoding, removal, storage, views, response_cache
+from services.response_cache import cached
 
 #######################################
 ### STARTING TO DEFINE ROUTES HERE ####
 #######################################
 videos_api = Blueprint('videos_api', __name__)
 
+# ?fields= and ?include= of the video listings, formats are embedded unless ?fields= is given alone
+VIDEO_FIELDS = ('id', 'name', 'source', 'view', 'enabled', 'comment_count', 'format_count', 'created_at')
+VIDEO_RELATIONS = ('formats',)
+
+# load_only of a listing: the pagination keys, and format_count to skip the videos without formats
+def video_columns(fields, include, needed=('id', 'created_at')):
+    return columns(Video, fields, needed + (('format_count',) if 'formats' in include else ()))
+
 # get all videos
 @videos_api.route('/videos', methods=['GET'])
+@cached(lambda: ['videos'])
 def getVideos():
     query_params = request.args
     name = query_params.get('name', None, type=str)
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
+    q = query_params.get('q', None, type=str)
+
+    try:
+        fields, include = fieldset(query_params, VIDEO_FIELDS, VIDEO_RELATIONS, VIDEO_RELATIONS)
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
+    options = video_columns(fields, include)
+
+    if q:
+        videos, pager = search.search(Video, q, query_params, options)
+        return jsonify({
+            'message': 'OK',
+            'data': dump_videos(videos, fields, 'formats' in include),
+            'pager': pager
+        })
 
     if name:
-        paginate = Video.query.filter(Video.name.like(name + '%')).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
+        query = Video.query.options(*options).filter(Video.enabled == True, Video.name.like(name + '%'))
     else:
-        paginate = Video.query.paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    videos = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+        query = Video.query.options(*options).filter(Video.enabled == True)
+
+    try:
+        videos, pager = paginate(query, (Video.created_at, Video.id), query_params)
+    except InvalidCursor:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
+
+    output = dump_videos(videos, fields, 'formats' in include)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output,
+        'pager': pager
+    })
+
+# get several videos at once, ?ids=1,2,3
+@videos_api.route('/videos/batch', methods=['GET'])
+@cached(lambda: ['videos'])
+def getVideosBatch():
+    try:
+        ids = parse_ids(request.args.get('ids'))
+    except InvalidBatch:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
 
-    if not videos:
-        videos = [] # possible options here: return empty array, or return 404 not found ? not sure
+    try:
+        fields, include = fieldset(request.args, VIDEO_FIELDS, VIDEO_RELATIONS, VIDEO_RELATIONS)
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
 
-    schema = VideoSchema(many=True)
-    output = schema.dump(videos)
+    videos = {video.id: video for video in Video.query.options(*video_columns(fields, include, ('id',))).filter(Video.id.in_(ids), Video.enabled == True)}
+    output = dump_videos([videos[videoId] for videoId in ids if videoId in videos], fields, 'formats' in include)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'errors': missing(ids, videos, 'Video not found')
     })
 
 # get user's videos
 @videos_api.route('/user/<int:userId>/videos', methods=['GET'])
+@cached(lambda userId: ['user:%d:videos' % userId])
 def getUserVideos(userId):
     query_params = request.args
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
 
-    paginate = Video.query.filter_by(user_id=userId).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    videos = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
+    try:
+        fields, include = fieldset(query_params, VIDEO_FIELDS, VIDEO_RELATIONS, VIDEO_RELATIONS)
+    except InvalidFields:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10003, # invalid fields or include
+            'data': ''
+        }), 400
 
-    if not videos:
-        videos = [] # possible options here: return empty array, or return 404 not found ? not sure
+    try:
+        videos, pager = paginate(Video.query.options(*video_columns(fields, include)).filter_by(user_id=userId, enabled=True), (Video.created_at, Video.id), query_params)
+    except InvalidCursor:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
 
-    schema = VideoSchema(many=True)
-    output = schema.dump(videos)
+    output = dump_videos(videos, fields, 'formats' in include)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
     })
 
 # create new video
@@ -80,8 +151,11 @@ def createVideo(current_user, userId):
     # see: http://flask.pocoo.org/docs/1.0/patterns/fileuploads/
     # and: https://werkzeug.palletsprojects.com/en/0.14.x/datastructures/#werkzeug.datastructures.FileStorage
     # and: https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Complete_list_of_MIME_types
-    ### user verif
-    user = User.query.filter_by(id=userId).first()
+    ### user verif, the token principal already proves the owner exists
+    if current_user is not None and current_user.id == userId:
+        user = current_user
+    else:
+        user = User.query.filter_by(id=userId, enabled=True).first()
 
     if not user:
         return jsonify({
@@ -106,13 +180,11 @@ def createVideo(current_user, userId):
     data = request.get_json() or request.form
     name = data.get('name')
     ### file mimetype check and save to storage
-    pattern = re.compile(r'^video\/')
-    file_mimetype = magic.from_buffer(file.read(1024), mime=True)
+    head = file.read(1024)
     file.stream.seek(0)
 
-    if pattern.match(file_mimetype):
-        file_path = secure_filename(user.username + '_' + str(datetime.utcnow()) + '_' + file.filename)
-        file.save(app.config['UPLOAD_FOLDER'] + file_path)
+    if is_video(head):
+        temp_path, digest, size = blobs.write(file.stream) # hashed while written, stored once per content
     else:
         return jsonify({
             'message': 'Bad request',
@@ -124,12 +196,14 @@ def createVideo(current_user, userId):
     try:
         newVideo = Video(
             name = name or secure_filename(file.filename),
-            source = (app.config['UPLOAD_FOLDER'] + file_path),
+            source = blobs.acquire(temp_path, digest, size, blobs.extension(file.filename)),
             user_id = user.id,
             created_at = datetime.utcnow()
         )
         db.session.add(newVideo)
+        search.index(newVideo)
         db.session.commit()
+        response_cache.invalidate(*response_cache.video_tags(newVideo))
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -143,8 +217,7 @@ def createVideo(current_user, userId):
             'data': err.args
         }), 500
 
-    schema = VideoSchema()
-    output = schema.dump(newVideo)
+    output = dump(VideoSchema, newVideo)
 
     return jsonify({
         'message': 'OK',
@@ -159,27 +232,11 @@ def encodeVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
 
-    ### file form verif
-    if ('file' not in request.files or
-        request.files['file'].filename == ''):
-        return jsonify({
-            'message': 'Bad request',
-            'code': 10020, # no file 
-            'data': ''
-        }), 400
-
-    file = request.files['file']
     data = request.get_json() or request.form
     format = data.get('format')
 
-    format_pattern = re.compile(r'[0-9]*')
+    format_pattern = re.compile(r'[0-9]+')
     if (format is None or type(format) is not (str or number) or format_pattern.fullmatch(format) is None):
         return jsonify({
             'message': 'Bad request',
@@ -187,40 +244,22 @@ def encodeVideo(current_user, videoId):
             'data': ''
         }), 400
 
-    pattern = re.compile(r'^video\/')
-    file_mimetype = magic.from_buffer(file.read(1024), mime=True)
-    file.stream.seek(0)
+    video = Video.query.filter_by(id=videoId, enabled=True).first()
+    if not video:
+        return jsonify({
+            'message': 'Video not found',
+        }), 404
 
-    if pattern.match(file_mimetype):
-        file_path = secure_filename(user.username + '_' + str(datetime.utcnow()) + '_' + format + '_' + file.filename)
-        file.save(app.config['UPLOAD_FOLDER'] + file_path)
-    else:
+    if video.user_id != current_user.id:
         return jsonify({
-            'message': 'Bad request',
-            'code': 10021, # wrong file type
-            'data': ''
-        }), 400
+            'message': 'Forbidden',
+        }), 403
 
-    ## save to db
-    exists_format = Video_Format.query.filter_by(video_id=videoId, code=format).first()
-    if exists_format is not None:
-        exists_format.uri = app.config['UPLOAD_FOLDER'] + file_path
-        db.session.commit()
-    else:
+    ### no file: encode it ourselves in the background
+    if ('file' not in request.files or
+        request.files['file'].filename == ''):
         try:
-            newFormat = Video_Format(
-                code = format,
-                uri = (app.config['UPLOAD_FOLDER'] + file_path),
-                video_id = videoId,
-            )
-            db.session.add(newFormat)
-            db.session.commit()
-        except exc.IntegrityError as err:
-            db.session.rollback()
-            return jsonify({
-                'message': 'Bad request',
-                'data': err.args
-            }), 400
+            job = encoding.enqueue(video, format)
         except Exception as err:
             db.session.rollback()
             return jsonify({
@@ -228,29 +267,123 @@ def encodeVideo(current_user, videoId):
                 'data': err.args
             }), 500
 
-    schema = VideoFormatSchema()
-    if exists_format:
-        output = schema.dump(exists_format)
+        output = dump(EncodingJobSchema, job)
+
+        return jsonify({
+            'message': 'Accepted',
+            'data': output
+        }), 202
+
+    file = request.files['file']
+
+    head = file.read(1024)
+    file.stream.seek(0)
+
+    if is_video(head):
+        temp_path, digest, size = blobs.write(file.stream)
     else:
-        output = schema.dump(newFormat)
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10021, # wrong file type
+            'data': ''
+        }), 400
 
+    ## save to db, one upsert on the (video_id, code) unique index
+    try:
+        tags = response_cache.video_tags(video)
+        encoding.save_format(videoId, format, blobs.acquire(temp_path, digest, size, blobs.extension(file.filename)))
+        db.session.commit()
+        response_cache.invalidate(*tags)
+    except exc.IntegrityError as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Bad request',
+            'data': err.args
+        }), 400
+    except Exception as err:
+        db.session.rollback()
+        return jsonify({
+            'message': 'Internal server error',
+            'data': err.args
+        }), 500
+
+    output = dump(VideoFormatSchema, Video_Format.query.filter_by(video_id=videoId, code=format).first())
 
     return jsonify({
         'message': 'OK',
         'data': output
     }), 200
 
-# update video
-@videos_api.route('/video/<int:videoId>', methods=['PUT'])
+# encoding job status and progress
+@videos_api.route('/job/<int:jobId>', methods=['GET'])
+def getEncodingJob(jobId):
+    job = Encoding_Job.query.filter_by(id=jobId).first()
+    if not job:
+        return jsonify({
+            'message': 'Job not found',
+        }), 404
+
+    output = dump(EncodingJobSchema, job)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 200
+
+# video's encoding jobs
+@videos_api.route('/video/<int:videoId>/jobs', methods=['GET'])
+def getVideoEncodingJobs(videoId):
+    jobs = Encoding_Job.query.filter_by(video_id=videoId).order_by(Encoding_Job.id).all()
+
+    output = dump(EncodingJobSchema, jobs, many=True)
+
+    return jsonify({
+        'message': 'OK',
+        'data': output
+    }), 200
+
+# retry a dead-lettered job
+@videos_api.route('/job/<int:jobId>/retry', methods=['POST'])
 @token_required
-def updateVideo(current_user, videoId):
+def retryEncodingJob(current_user, jobId):
     if not current_user:
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
+
+    job = Encoding_Job.query.filter_by(id=jobId).first()
+    if not job:
+        return jsonify({
+            'message': 'Job not found',
+        }), 404
+
+    owner = db.session.query(Video.user_id).filter(Video.id == job.video_id).scalar()
+    if owner != current_user.id:
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+
+    if job.status != 'dead':
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10030, # job is not dead-lettered
+            'data': ''
+        }), 400
+
+    encoding.retry(job)
+
+    output = dump(EncodingJobSchema, job)
+
+    return jsonify({
+        'message': 'Accepted',
+        'data': output
+    }), 202
+
+# update video
+@videos_api.route('/video/<int:videoId>', methods=['PUT'])
+@token_required
+def updateVideo(current_user, videoId):
+    if not current_user:
         return jsonify({
             'message': 'Forbidden',
         }), 403
@@ -265,17 +398,18 @@ def updateVideo(current_user, videoId):
             'data': ''
         }), 400
     
-    video = Video.query.filter_by(id=videoId).first()
+    video = Video.query.filter_by(id=videoId, enabled=True).first()
     if not video:
         return jsonify({
             'message': 'Video not found',
         }), 404
 
     video.name = name
+    search.index(video)
     db.session.commit()
+    response_cache.invalidate(*response_cache.video_tags(video))
 
-    schema = VideoSchema()
-    output = schema.dump(video)
+    output = dump(VideoSchema, video)
 
     return jsonify({
         'message': 'OK',
@@ -290,23 +424,19 @@ def deleteVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
 
-    video = Video.query.filter_by(id=videoId).first()
+    video = Video.query.filter_by(id=videoId, enabled=True).first()
     if not video:
         return jsonify({
             'message': 'Video not found',
         }), 404
 
-    db.session.delete(video)
-    db.session.commit()
+    removal.delete_video(video) # hidden now, formats, comments, jobs and blobs follow in the background
+    response_cache.invalidate(*response_cache.video_tags(video))
 
-    return jsonify({}), 204
+    return jsonify({
+        'message': 'Accepted',
+    }), 202
     
 # comment video
 @videos_api.route('/video/<int:videoId>/comment', methods=['POST'])
@@ -316,12 +446,6 @@ def commentVideo(current_user, videoId):
         return jsonify({
             'message': 'Forbidden',
         }), 403
-    
-    user = User.query.filter_by(id=current_user.id).first()
-    if not user:
-        return jsonify({
-            'message': 'Forbidden',
-        }), 403
 
     data = request.get_json() or request.form
     body = data.get('body')
@@ -333,7 +457,7 @@ def commentVideo(current_user, videoId):
             'data': ''
         }), 400
     
-    video = Video.query.filter_by(id=videoId).first()
+    video = Video.query.filter_by(id=videoId, enabled=True).first()
     if not video:
         return jsonify({
             'message': 'Video not found',
@@ -346,7 +470,9 @@ def commentVideo(current_user, videoId):
             video_id = video.id
         )
         db.session.add(newComment)
+        counters.add_comments(video.id)
         db.session.commit()
+        response_cache.invalidate(*response_cache.video_tags(video))
     except exc.IntegrityError as err:
         db.session.rollback()
         return jsonify({
@@ -360,41 +486,134 @@ def commentVideo(current_user, videoId):
             'data': err.args
         }), 500
 
-    schema = CommentSchema()
-    output = schema.dump(newComment)
+    output = dump(CommentSchema, newComment)
 
     return jsonify({
         'message': 'OK',
         'data': output
     }), 200
 
+# comment several videos at once, {"comments": [{"video_id": 1, "body": "..."}, ...]}
+# the valid items are saved in one transaction, the others are reported by index. the
+# comments created come back with their index and video_id too
+@videos_api.route('/comments/batch', methods=['POST'])
+@token_required
+def commentVideosBatch(current_user):
+    if not current_user:
+        return jsonify({
+            'message': 'Forbidden',
+        }), 403
+
+    try:
+        items = parse_items(request.get_json(silent=True), 'comments')
+    except InvalidBatch:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10001, # invalid form
+            'data': ''
+        }), 400
+
+    valid = lambda item: type(item) is dict and type(item.get('video_id')) is int and type(item.get('body')) is str
+    wanted = {item['video_id'] for item in items if valid(item)}
+    videos = {video.id: video for video in Video.query.filter(Video.id.in_(wanted), Video.enabled == True)} if wanted else {}
+
+    newComments = []
+    indexes = [] # position in the request of each new comment
+    errors = []
+    for index, item in enumerate(items):
+        if not valid(item):
+            errors.append({'index': index, 'message': 'Bad request', 'code': 10001}) # invalid form
+        elif item['video_id'] not in videos:
+            errors.append({'index': index, 'message': 'Video not found'})
+        else:
+            newComments.append(Comment(
+                body = item['body'],
+                user_id = current_user.id,
+                video_id = item['video_id']
+            ))
+            indexes.append(index)
+
+    output = []
+    if newComments:
+        try:
+            db.session.add_all(newComments)
+            for videoId, count in Counter(comment.video_id for comment in newComments).items():
+                counters.add_comments(videoId, count)
+            db.session.flush()
+            output = dump(CommentSchema, newComments, many=True) # before the commit expires them
+            for index, comment, created in zip(indexes, newComments, output):
+                created.update({'index': index, 'video_id': comment.video_id}) # as the errors
+            tags = {tag for comment in newComments for tag in response_cache.video_tags(videos[comment.video_id])}
+            db.session.commit()
+            response_cache.invalidate(*tags)
+        except exc.IntegrityError as err:
+            db.session.rollback()
+            return jsonify({
+                'message': 'Bad request',
+                'data': err.args
+            }), 400
+        except Exception as err:
+            db.session.rollback()
+            return jsonify({
+                'message': 'Internal server error',
+                'data': err.args
+            }), 500
+
+    return jsonify({
+        'message': 'OK',
+        'data': output,
+        'errors': errors
+    }), 200
+
 # get video's comments
 @videos_api.route('/video/<int:videoId>/comments', methods=['GET'])
+@cached(lambda videoId: ['video:%d:comments' % videoId])
 def getVideoComments(videoId):
     query_params = request.args
-    page = query_params.get('page', 1, type=int)
-    perPage = query_params.get('perPage', 20, type=int)
-
-    paginate = Comment.query.filter_by(video_id=videoId).paginate(page = page, per_page = perPage, error_out = False) # if error_out = False, page and perPage defauls to 1 & 20 respectivly
-    
-    comments = paginate.items
-    total = paginate.pages # total of pages for parameter perPage
 
-    if not comments:
-        comments = [] # possible options here: return empty array, or return 404 not found ? not sure
+    try:
+        comments, pager = paginate(Comment.query.filter_by(video_id=videoId), (Comment.id,), query_params) # comments have no created_at, id is monotonic
+    except InvalidCursor:
+        return jsonify({
+            'message': 'Bad request',
+            'code': 10002, # invalid cursor
+            'data': ''
+        }), 400
 
-    schema = CommentSchema(many=True)
-    output = schema.dump(comments)
+    output = dump(CommentSchema, comments, many=True)
 
     return jsonify({
         'message': 'OK',
         'data': output,
-        'pager': {
-            'current': page,
-            'total': total
-        }
+        'pager': pager
     })
 
-@videos_api.route('/uploads/<filename>')
+@videos_api.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if storage.is_scratch(filename):
+        abort(404)
+
+    store = storage.backend()
+    if store.name == 'local':
+        response = send_upload(filename)
+    else:
+        response = redirect(store.url(filename)) # the object store serves the bytes (and ranges)
+
+    # a playback starts with a full GET or a range from byte 0, seeks and revalidations are not views
+    range_header = request.headers.get('Range', '')
+    if response.status_code in (200, 206, 302) and (not range_header or range_header.startswith('bytes=0-')):
+        views.record_file(filename)
+
+    return response
+
+# explicit playback, for players that don't fetch through /uploads
+@videos_api.route('/video/<int:videoId>/view', methods=['POST'])
+def viewVideo(videoId):
+    if db.session.query(Video.id).filter_by(id=videoId, enabled=True).first() is None:
+        return jsonify({
+            'message': 'Video not found',
+        }), 404
+
+    views.record(videoId)
+
+    return jsonify({}), 204
@@ -1,19 +1,23 @@
 ##
 ## FILE WHERE WE RUN THE APP,
-## IMPORTING OTHER STUFFS IN HERE (app, blueprints, models to create db..)
+## BUILDING THE APP OF THIS PROCESS (see create_app in app.py)
 ##
 
-from app import app
-from models import *
+from app import create_app
+from services import search, encoding, removal, sessions
+import migrations
 
-from routes.users import users_api
-from routes.auth import auth_api
-from routes.videos import videos_api
+app = create_app()
 
-app.register_blueprint(users_api)
-app.register_blueprint(auth_api)
-app.register_blueprint(videos_api)
+# once per process, before serving
+def startup():
+    with app.app_context():
+        migrations.upgrade() # create or upgrade the schema
+        search.available() # create and backfill the full-text index before serving
+        encoding.start(recover=True) # resume jobs left behind by the last run
+        removal.start(recover=True) # and deletions
+        sessions.start() # revoked tokens, loaded before the first request
 
 if __name__ == '__main__': # only run if called from this file (name = main in this case only)
-    db.create_all(app=app) # create tables if not exists
-    app.run(port=int(1407)) # listen on port 1407
\ No newline at end of file
+    startup()
+    app.run(port=int(1407)) # listen on port 1407
@@ -0,0 +1,274 @@
+##
+## FILE WHERE WE RUN THE APP ON EVERY CORE (PRE-FORK)
+## the master migrates the schema, builds the search index, compiles the mappers and
+## schemas once, then forks SERVE_WORKERS processes that share that memory copy-on-write
+## and accept on the same socket. every worker reports its health to the master through
+## a pipe, the master writes the reports to SERVE_STATUS_FILE and replaces the workers
+## that die or stop reporting. signals to the master:
+##   TERM / INT: stop, workers finish their requests first
+##   HUP: reload with no downtime, a new master (new code and config) starts on the same
+##        socket, once its workers report it stops the old one
+## run with `python serve.py [--host 127.0.0.1] [--port 1407] [--workers N]`
+##
+
+from sqlalchemy.orm import configure_mappers
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+import argparse
+import gc
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from app import db
+from run import app # the app of this process, its blueprints registered
+import migrations
+from models import UserSchema, VideoSchema, VideoListSchema, VideoFormatSchema, CommentSchema, UploadSchema, EncodingJobSchema
+from services import encoding, removal, search, serialization, sessions, views
+
+# what the routes dump, compiled before the fork
+SCHEMAS = [
+    (UserSchema, ('id', 'username', 'pseudo', 'created_at'), True),
+    (UserSchema, ('id', 'username', 'pseudo', 'created_at'), False),
+    (UserSchema, ('id', 'username', 'pseudo', 'email', 'created_at'), False),
+    (VideoSchema, None, False),
+    (VideoListSchema, None, True),
+    (VideoFormatSchema, None, True),
+    (CommentSchema, None, False),
+    (CommentSchema, None, True),
+    (UploadSchema, None, False),
+    (EncodingJobSchema, None, False),
+    (EncodingJobSchema, None, True),
+]
+
+################
+#### MASTER ####
+################
+
+# everything done once for all the workers, no thread and no connection may cross the fork.
+# on a reload the old workers are still running their jobs and deletions: only the ones
+# whose lease ran out are taken back, and never by the master taking over
+def prepare(reloading=False):
+    with app.app_context():
+        migrations.upgrade()
+        search.available()
+        if not reloading:
+            encoding.requeue() # left running by a previous run that died
+            removal.requeue()
+        configure_mappers()
+        serialization.warm(SCHEMAS)
+        db.session.remove()
+        db.engine.dispose()
+        read_engine = db.get_read_engine()
+        if read_engine is not None:
+            read_engine.dispose()
+    gc.collect()
+    gc.freeze() # keep the collector from touching (and copying) the shared pages
+
+def listen(host, port, fd=None):
+    if fd is not None:
+        sock = socket.socket(fileno=fd)
+    else:
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+class Master:
+    def __init__(self, sock, host, count, replace=None):
+        self.sock = sock
+        self.host = host
+        self.count = count
+        self.replace = replace # pid of the master we take over from
+        self.workers = {} # pid -> report
+        self.stopping = False
+        self.reloading = False
+        self.started = time.time()
+
+    def spawn(self):
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            code = 0
+            try:
+                worker(self.sock, self.host, writer)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(writer)
+        self.workers[pid] = {'pid': pid, 'fd': reader, 'buffer': b'', 'started': time.time(), 'seen': time.time(), 'ready': False}
+
+    def read_reports(self, timeout):
+        fds = {worker['fd']: worker for worker in self.workers.values()}
+        if not fds:
+            time.sleep(timeout)
+            return
+        readable = select.select(list(fds), [], [], timeout)[0]
+        for fd in readable:
+            worker = fds[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                continue # exited, reaped below
+            lines = (worker['buffer'] + data).split(b'\n')
+            worker['buffer'] = lines.pop()
+            for line in lines:
+                worker.update(json.loads(line.decode('utf-8')))
+                worker['seen'] = time.time()
+                worker['ready'] = True
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue # the master started by a reload
+            os.close(worker['fd'])
+            if not self.stopping:
+                app.logger.warning('worker %d exited (status %d), replacing it', pid, status)
+                self.spawn()
+
+    def kill_stale(self):
+        for pid, worker in list(self.workers.items()):
+            if time.time() - worker['seen'] > app.config['SERVE_WORKER_TIMEOUT']:
+                app.logger.warning('worker %d stopped reporting, killing it', pid)
+                worker['seen'] = time.time()
+                os.kill(pid, signal.SIGKILL)
+
+    def write_status(self):
+        path = app.config.get('SERVE_STATUS_FILE')
+        if not path:
+            return
+        status = {
+            'master': os.getpid(),
+            'started': self.started,
+            'stopping': self.stopping,
+            'workers': [
+                {key: value for key, value in worker.items() if key not in ('fd', 'buffer')}
+                for worker in sorted(self.workers.values(), key=lambda worker: worker['started'])
+            ],
+        }
+        with open(path + '.tmp', 'w') as out:
+            json.dump(status, out, indent=2)
+        os.replace(path + '.tmp', path)
+
+    # start the master of the new code on our socket, it stops us once its workers report
+    def reload(self):
+        self.reloading = False
+        argv = [sys.executable, os.path.abspath(__file__), '--host', self.host, '--fd', str(self.sock.fileno()),
+            '--workers', str(self.count), '--replace', str(os.getpid())]
+        subprocess.Popen(argv, pass_fds=(self.sock.fileno(),))
+
+    def stop(self):
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + app.config['SERVE_GRACEFUL_TIMEOUT'] + 5
+        while self.workers and time.time() < deadline:
+            self.read_reports(0.2)
+            self.reap()
+        for pid in self.workers:
+            os.kill(pid, signal.SIGKILL)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda *args: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *args: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGHUP, lambda *args: setattr(self, 'reloading', True))
+        for _ in range(self.count):
+            self.spawn()
+
+        while not self.stopping:
+            self.read_reports(1)
+            self.reap()
+            self.kill_stale()
+            if self.replace and all(worker['ready'] for worker in self.workers.values()):
+                os.kill(self.replace, signal.SIGTERM) # we are serving, the old master can go
+                self.replace = None
+            if self.reloading:
+                self.reload()
+            self.write_status()
+
+        self.stop()
+        self.write_status()
+
+################
+#### WORKER ####
+################
+
+def worker(sock, host, report):
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopped.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the master stops us
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    stats = {'requests': 0, 'active': 0}
+    lock = threading.Lock()
+
+    def done():
+        with lock:
+            stats['active'] -= 1
+
+    def counted(environ, start_response):
+        with lock:
+            stats['requests'] += 1
+            stats['active'] += 1
+        try:
+            return ClosingIterator(app(environ, start_response), done)
+        except Exception:
+            done()
+            raise
+
+    def heartbeat():
+        while not stopped.is_set():
+            with lock:
+                line = dict(stats, rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, at=time.time())
+            try:
+                os.write(report, (json.dumps(line) + '\n').encode('utf-8'))
+            except OSError:
+                return # master gone
+            stopped.wait(app.config['SERVE_HEARTBEAT'])
+
+    with app.app_context():
+        encoding.start() # jobs queued by any worker are claimed atomically
+        removal.start()
+        sessions.start()
+    server = make_server(host, 0, counted, threaded=True, fd=sock.fileno())
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    threading.Thread(target=lambda: (stopped.wait(), server.shutdown()), name='shutdown', daemon=True).start()
+    server.serve_forever()
+
+    # no new connection from here, let the requests in flight finish
+    deadline = time.time() + app.config['SERVE_GRACEFUL_TIMEOUT']
+    while stats['active'] and time.time() < deadline:
+        time.sleep(0.05)
+    views.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve the api with a pre-forked process per core')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1407)
+    parser.add_argument('--workers', type=int, default=None, help='default: SERVE_WORKERS, or one per core')
+    parser.add_argument('--fd', type=int, default=None, help=argparse.SUPPRESS) # inherited socket, on reload
+    parser.add_argument('--replace', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    count = args.workers or app.config['SERVE_WORKERS'] or os.cpu_count() or 1
+    sock = listen(args.host, args.port, args.fd)
+    prepare(reloading=args.replace is not None)
+    Master(sock, args.host, count, args.replace).run()
@@ -0,0 +1,234 @@
+##
+## FILE WHERE WE SERVE THE APP ON AN ASGI SERVER (see asgi.py)
+## the event loop owns the connections: a request body is received asynchronously
+## (spooled to disk above ASGI_SPOOL_SIZE) before any thread sees it, and the response
+## is pulled from the app ASGI_SEND_SIZE bytes at a time then sent with the server's
+## backpressure. a thread only runs the route and produces the next block, so slow
+## clients, big uploads and long downloads hold a coroutine, not a worker thread.
+## a request holds a lane (a single thread) of its own until its response is over: flask's
+## context stack, the scoped db session and the sqlite cursors of a streamed response are
+## per thread, so two requests never share one. a response produced in one pull gives
+## its lane back before it is sent, requests beyond ASGI_THREADS wait for a free lane
+##
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import sys
+import tempfile
+
+class Lane:
+    def __init__(self, index):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asgi-%d' % index)
+
+class WsgiBridge:
+    def __init__(self, wsgi_app, threads=32, spool_size=1024 * 1024, send_size=64 * 1024, max_body=None, startup=None):
+        self.wsgi_app = wsgi_app
+        self.lanes = [Lane(i) for i in range(threads)]
+        self.free = None # queue of the idle lanes, made on the server's loop
+        self.spool_size = spool_size
+        self.send_size = send_size
+        self.max_body = max_body
+        self.startup = startup
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else: # websocket
+            await send({'type': 'websocket.close'})
+
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if self.startup is not None:
+                        await loop.run_in_executor(None, self.startup)
+                except Exception as err:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(err)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for lane in self.lanes:
+                    lane.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    ##############
+    #### HTTP ####
+    ##############
+
+    async def http(self, scope, receive, send):
+        declared = header(scope, b'content-length')
+        if self.max_body is not None and declared is not None and declared.isdigit() and int(declared) > self.max_body:
+            return await self.error(send, 413, 'Request entity too large')
+
+        body = await self.read_body(receive)
+        if body is None:
+            return await self.error(send, 413, 'Request entity too large')
+        if body is False: # client went away
+            return
+
+        loop = asyncio.get_event_loop()
+        lane = None
+        response = None
+        watcher = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            lane = await self.acquire()
+            run = lambda f, *args: loop.run_in_executor(lane.executor, f, *args)
+            response = await run(self.start, environ(scope, body[0], body[1]))
+            status, headers, block, done, iterator, iterable = response
+            if done: # closed in start, nothing of the request is left on the thread
+                self.release(lane)
+                lane = None
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+            while not done:
+                await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+                if watcher.done(): # client went away, stop producing
+                    return
+                block, done = await run(self.pull, iterator)
+            await send({'type': 'http.response.body', 'body': block, 'more_body': False})
+        finally:
+            watcher.cancel()
+            if lane is not None:
+                if response is not None:
+                    await run(close, response[5])
+                self.release(lane)
+            body[0].close()
+
+    async def acquire(self):
+        if self.free is None:
+            self.free = asyncio.Queue()
+            for lane in self.lanes:
+                self.free.put_nowait(lane)
+        return await self.free.get()
+
+    def release(self, lane):
+        self.free.put_nowait(lane)
+
+    # (file, size), None when it is over max_body, False when the client disconnected
+    async def read_body(self, receive):
+        loop = asyncio.get_event_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return False
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                return None
+            if size > self.spool_size: # on disk now, keep the loop free of file writes
+                await loop.run_in_executor(None, body.write, chunk)
+            elif chunk:
+                body.write(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body, size
+
+    async def error(self, send, status, message):
+        payload = json.dumps({'message': message}).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode('ascii'))],
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    ######################################
+    #### RUN IN THE LANE OF A REQUEST ####
+    ######################################
+
+    # run the route, returns (status, headers, first block, done, iterator, iterable)
+    def start(self, env):
+        started = []
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return written.append # legacy write(), buffered
+
+        iterable = self.wsgi_app(env, start_response)
+        iterator = iter(iterable)
+        try:
+            block, done = self.pull(iterator, b''.join(written))
+        except Exception:
+            close(iterable)
+            raise
+        if done:
+            close(iterable)
+        return started[0], started[1], block, done, iterator, iterable
+
+    # the next block of at least send_size bytes, and whether the body is over
+    def pull(self, iterator, block=b''):
+        blocks = [block] if block else []
+        size = len(block)
+        for chunk in iterator:
+            if chunk:
+                blocks.append(chunk)
+                size += len(chunk)
+                if size >= self.send_size:
+                    return b''.join(blocks), False
+        return b''.join(blocks), True
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def close(iterable):
+    if hasattr(iterable, 'close'):
+        iterable.close()
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+# PEP 3333 environ of an ASGI http scope, strings are latin-1 decoded bytes
+def environ(scope, body, size):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    env = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(size),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue # the body is complete, its real size is set above
+        if name == 'CONTENT_TYPE':
+            env['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name
+        env[key] = env[key] + ',' + value if key in env else value
+    return env
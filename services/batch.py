@@ -0,0 +1,32 @@
+##
+## FILE WHERE WE DEFINE THE BATCH HELPERS
+## a batch names up to MAX_ITEMS entities, the route resolves them with one IN-query
+## per entity type and reports the items that failed next to the ones that didn't
+##
+
+MAX_ITEMS = 100
+
+class InvalidBatch(ValueError):
+    pass
+
+# '3,1,3,2' -> [3, 1, 2], duplicates dropped, order kept
+def parse_ids(value):
+    try:
+        ids = [int(part) for part in (value or '').split(',') if part.strip()]
+    except ValueError:
+        raise InvalidBatch(value)
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAX_ITEMS:
+        raise InvalidBatch(value)
+    return ids
+
+# the list of a write batch body, e.g. {"comments": [...]}
+def parse_items(data, key):
+    items = data.get(key) if isinstance(data, dict) else None
+    if type(items) is not list or not items or len(items) > MAX_ITEMS:
+        raise InvalidBatch(key)
+    return items
+
+# the ids asked for and not found
+def missing(ids, found, message):
+    return [{'id': entityId, 'message': message} for entityId in ids if entityId not in found]
@@ -0,0 +1,129 @@
+##
+## FILE WHERE WE DEFINE THE CONTENT-ADDRESSED UPLOAD STORAGE
+## files are hashed while they are written to a temporary file, then stored once
+## under the key of their sha256 (see services/storage.py). a Blob row counts the
+## Video.source and Video_Format.uri pointing at it: acquire() adds a reference,
+## release() drops one and once the transaction commits, blobs left without references
+## are deleted (row and file). files written before this storage have no Blob row
+## (never collected) until migrate_storage.py moves them in
+##
+
+from flask import current_app
+from sqlalchemy import event, orm, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.utils import secure_filename
+from datetime import datetime
+import hashlib
+import os
+import uuid
+
+from app import db
+from models import Blob
+from services import storage
+
+BLOCK_SIZE = 64 * 1024
+
+# resumable uploads are assembled here before they become a blob (see routes/uploads.py)
+def partial_path(upload):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'partial', upload.id)
+
+def temp_path():
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, uuid.uuid4().hex)
+
+def extension(filename):
+    return os.path.splitext(secure_filename(filename or ''))[1].lower()
+
+# copy a stream to a temporary file, returns (path, sha256, size)
+def write(stream):
+    path = temp_path()
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as out:
+        for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+            out.write(block)
+            digest.update(block)
+            size += len(block)
+    return path, digest.hexdigest(), size
+
+# (sha256, size) of a file already on disk
+def hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# take a reference on the blob of a temporary file, store it when the content is new,
+# returns the uri to save. the file is removed unless keep, then the caller removes it
+# once its commit went through. the slow part (copy or upload) happens before the upsert,
+# which then holds SQLite's write lock until the commit: the presence check made under
+# that lock guarantees a concurrent collect() didn't delete the file in between
+def acquire(path, digest, size, ext='', keep=False):
+    store = storage.backend()
+    existing = db.session.query(Blob.uri).filter(Blob.digest == digest).scalar()
+    key = storage.key_of(existing) if existing else storage.blob_key(digest, ext)
+    if not store.exists(key):
+        store.put(key, path)
+
+    upsert = sqlite_insert(Blob).values(
+        digest = digest,
+        uri = storage.uri_of(key),
+        size = size,
+        refs = 1,
+        created_at = datetime.utcnow()
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements = ['digest'],
+        set_ = {'refs': Blob.refs + 1}
+    )
+    db.session.execute(upsert)
+    uri = db.session.query(Blob.uri).filter(Blob.digest == digest).scalar()
+
+    if not store.exists(storage.key_of(uri)):
+        store.put(storage.key_of(uri), path)
+    if not keep:
+        discard(path)
+    return uri
+
+# drop a reference, the blob is collected after the commit if it was the last one
+def release(uri):
+    if not uri:
+        return
+    released = db.session.execute(
+        text('UPDATE blob SET refs = refs - 1 WHERE uri = :uri'), {'uri': uri}
+    ).rowcount
+    if released:
+        db.session.info.setdefault('released_blobs', set()).add(uri)
+
+# delete the blobs of these uris that have no reference left
+def collect(uris):
+    deleted = 0
+    for uri in uris:
+        with db.engine.begin() as conn:
+            if conn.execute(text('DELETE FROM blob WHERE uri = :uri AND refs <= 0'), {'uri': uri}).rowcount:
+                storage.backend().delete(storage.key_of(uri))
+                deleted += 1
+    return deleted
+
+@event.listens_for(orm.Session, 'after_commit')
+def collect_released(session):
+    uris = session.info.pop('released_blobs', None)
+    if uris:
+        try:
+            collect(uris)
+        except Exception:
+            current_app.logger.exception('blob collection failed')
+
+@event.listens_for(orm.Session, 'after_rollback')
+def forget_released(session):
+    session.info.pop('released_blobs', None)
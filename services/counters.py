@@ -0,0 +1,34 @@
+##
+## FILE WHERE WE MAINTAIN THE DENORMALIZED COUNTERS OF VIDEO
+## Video.comment_count and Video.format_count change in the transaction of the write
+## that changes the rows they count, listings read them instead of the comment and
+## format tables. repair() recomputes them in id batches, for drift after manual edits
+## (python repair_counts.py)
+##
+
+from sqlalchemy import text
+
+from app import db
+from models import Video
+
+REPAIR_BATCH_SIZE = 5000
+
+def add_comments(videoId, count=1):
+    Video.query.filter_by(id=videoId).update({Video.comment_count: Video.comment_count + count}, synchronize_session=False)
+
+def add_formats(videoId, count=1):
+    Video.query.filter_by(id=videoId).update({Video.format_count: Video.format_count + count}, synchronize_session=False)
+
+# returns the number of videos whose counters were wrong
+def repair(batch_size=REPAIR_BATCH_SIZE):
+    comments = '(SELECT COUNT(*) FROM comment WHERE comment.video_id = video.id)'
+    formats = '(SELECT COUNT(*) FROM video__format WHERE video__format.video_id = video.id)'
+    last = db.session.execute(text('SELECT MAX(id) FROM video')).scalar() or 0
+    fixed = 0
+    for start in range(0, last, batch_size):
+        fixed += db.session.execute(text(
+            'UPDATE video SET comment_count = %s, format_count = %s '
+            'WHERE id > :start AND id <= :end AND (comment_count != %s OR format_count != %s)' % (comments, formats, comments, formats)
+        ), {'start': start, 'end': start + batch_size}).rowcount
+        db.session.commit() # one short write transaction per batch
+    return fixed
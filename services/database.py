@@ -0,0 +1,75 @@
+##
+## FILE WHERE WE DEFINE THE DATABASE PROFILE
+## SQLITE_PRAGMAS are applied on every new sqlite connection, and with
+## SQLALCHEMY_READ_POOL the session of a GET/HEAD request reads through a second,
+## query_only engine so GET traffic never waits behind upload commits in the
+## write pool (flushes always go to the write engine)
+##
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+import sqlite3
+import threading
+
+try:
+    from flask_sqlalchemy import SignallingSession
+except ImportError: # flask-sqlalchemy 3 has no SignallingSession, reads stay on the main engine
+    SignallingSession = None
+
+_pragmas = {}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+def set_query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+if SignallingSession is not None:
+    class RoutingSession(SignallingSession):
+        def __init__(self, db, **options):
+            self.db = db
+            SignallingSession.__init__(self, db, **options)
+
+        def get_bind(self, mapper=None, clause=None):
+            if not self._flushing and has_request_context() and request.method in ('GET', 'HEAD'):
+                engine = self.db.get_read_engine()
+                if engine is not None:
+                    return engine
+            return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        self._read_lock = threading.Lock()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        _pragmas.update(app.config.get('SQLITE_PRAGMAS', {}))
+        SQLAlchemy.init_app(self, app)
+
+    def create_session(self, options):
+        if SignallingSession is None:
+            return SQLAlchemy.create_session(self, options)
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    # second engine on the same database, None when SQLALCHEMY_READ_POOL is off
+    def get_read_engine(self):
+        app = self.get_app()
+        if not app.config.get('SQLALCHEMY_READ_POOL'):
+            return None
+        extensions = app.extensions # one per app, like the write engine
+        if 'read_engine' not in extensions:
+            with self._read_lock:
+                if 'read_engine' not in extensions:
+                    engine = create_engine(self.get_engine(app).url, **app.config.get('SQLALCHEMY_READ_ENGINE_OPTIONS', {}))
+                    if engine.dialect.name == 'sqlite':
+                        event.listen(engine, 'connect', set_query_only)
+                    extensions['read_engine'] = engine
+        return extensions['read_engine']
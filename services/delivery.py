@@ -0,0 +1,161 @@
+##
+## FILE WHERE WE SERVE THE UPLOADED FILES
+## single and multi Range (206), strong ETag / Last-Modified validators (304),
+## long lived cache headers, and an optional X-Accel-Redirect / X-Sendfile offload
+## so a front proxy pushes the bytes with sendfile instead of the WSGI worker
+##
+
+from flask import Response, abort, current_app, request
+from werkzeug.http import http_date, parse_date, parse_etags
+from werkzeug.wsgi import wrap_file
+from urllib.parse import quote
+import mimetypes
+import os
+import re
+import uuid
+
+try:
+    from werkzeug.utils import safe_join
+except ImportError: # werkzeug < 2.2
+    from werkzeug.security import safe_join
+
+BLOCK_SIZE = 64 * 1024
+MAX_RANGES = 16 # more than that and we serve the whole file
+range_pattern = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# parse a Range header into sorted, merged [start, stop) pairs clamped to length
+# returns None when the header must be ignored and [] when nothing is satisfiable
+def parse_ranges(header, length):
+    if not header or not header.startswith('bytes='):
+        return None
+
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        match = range_pattern.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '': # suffix range: the last N bytes
+            start, stop = max(length - int(last), 0), length
+        else:
+            start = int(first)
+            stop = length if last == '' else min(int(last) + 1, length)
+            if last != '' and int(last) < start:
+                return None
+        if start < stop:
+            ranges.append([start, stop])
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+def read_range(path, start, stop):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = file.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def multipart_body(path, ranges, length, mimetype, boundary):
+    for start, stop in ranges:
+        yield ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, mimetype, start, stop - 1, length
+        )).encode('ascii')
+        for block in read_range(path, start, stop):
+            yield block
+    yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+def multipart_length(ranges, length, mimetype, boundary):
+    total = len(('\r\n--%s--\r\n' % boundary).encode('ascii'))
+    for start, stop in ranges:
+        total += len(('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, mimetype, start, stop - 1, length
+        )).encode('ascii')) + stop - start
+    return total
+
+# the validators only change when the bytes change (uploads are never rewritten in place)
+def validators(stat):
+    etag = '%x-%x-%x' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return etag, int(stat.st_mtime)
+
+def not_modified(etag, mtime):
+    if request.headers.get('If-None-Match'):
+        return parse_etags(request.headers['If-None-Match']).contains(etag)
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and since.timestamp() >= mtime
+
+# Range is honoured only when If-Range still matches the current representation
+def if_range_matches(etag, mtime):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == '"%s"' % etag
+    since = parse_date(if_range)
+    return since is not None and since.timestamp() >= mtime
+
+def send_upload(filename):
+    folder = current_app.config['UPLOAD_FOLDER']
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    stat = os.stat(path)
+    length = stat.st_size
+    etag, mtime = validators(stat)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': '"%s"' % etag,
+        'Last-Modified': http_date(mtime),
+        'Cache-Control': 'public, max-age=%d, immutable' % current_app.config['UPLOAD_CACHE_MAX_AGE'],
+        'Accept-Ranges': 'bytes',
+    }
+
+    if not_modified(etag, mtime):
+        return Response(status=304, headers=headers)
+
+    # let the front proxy serve the bytes, it handles Range and conditionals itself
+    offload = current_app.config.get('SENDFILE_OFFLOAD')
+    if offload == 'x-accel':
+        headers['X-Accel-Redirect'] = current_app.config['SENDFILE_ACCEL_PREFIX'] + quote(filename) # a uri, nginx decodes it
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if offload == 'x-sendfile':
+        headers['X-Sendfile'] = os.path.abspath(path)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    ranges = None
+    if request.headers.get('Range') and if_range_matches(etag, mtime):
+        ranges = parse_ranges(request.headers['Range'], length)
+
+    if ranges == []:
+        headers['Content-Range'] = 'bytes */%d' % length
+        return Response(status=416, headers=headers)
+
+    if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+        headers['Content-Length'] = str(stop - start)
+        return Response(read_range(path, start, stop), status=206, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    if ranges:
+        boundary = uuid.uuid4().hex
+        headers['Content-Length'] = str(multipart_length(ranges, length, mimetype, boundary))
+        return Response(
+            multipart_body(path, ranges, length, mimetype, boundary), status=206, headers=headers,
+            content_type='multipart/byteranges; boundary=%s' % boundary, direct_passthrough=True
+        )
+
+    # whole file, wsgi.file_wrapper lets the server use sendfile when it can
+    headers['Content-Length'] = str(length)
+    return Response(wrap_file(request.environ, open(path, 'rb'), BLOCK_SIZE), status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
@@ -0,0 +1,263 @@
+##
+## FILE WHERE WE DEFINE THE SERVER-SIDE ENCODING JOB QUEUE
+## PATCH /video/<id> without a file enqueues an Encoding_Job row, a dispatcher thread
+## claims queued jobs and runs at most ENCODING_WORKERS encoder processes at once,
+## failed jobs are retried up to ENCODING_MAX_ATTEMPTS times then dead-lettered.
+## a claimed job holds a lease the dispatcher renews while the job runs, a running job
+## whose lease ran out was left by a dead process and is queued again
+##
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import or_
+from datetime import datetime, timedelta
+import shutil
+import subprocess
+import tempfile
+import threading
+import traceback
+
+from app import db
+from models import Video, Video_Format, Encoding_Job
+from services import blobs, counters, response_cache, storage
+
+class EncodingError(Exception):
+    pass
+
+##################
+#### ENCODERS ####
+##################
+
+# an encoder writes `target` from `source` for a format code (the output height)
+# and reports its progress in percent through the callback
+
+class StubEncoder:
+    name = 'stub'
+
+    def encode(self, source, target, code, progress, timeout):
+        shutil.copyfile(source, target)
+        progress(100)
+
+class FfmpegEncoder:
+    name = 'ffmpeg'
+
+    def duration(self, source):
+        try:
+            output = subprocess.run(
+                ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', source],
+                capture_output=True, text=True, timeout=60
+            ).stdout
+            return float(output.strip())
+        except (ValueError, subprocess.SubprocessError):
+            return None
+
+    # stderr goes to a file: a full stderr pipe nobody reads while we follow stdout would
+    # block ffmpeg, and us with it
+    def encode(self, source, target, code, progress, timeout):
+        duration = self.duration(source)
+        with tempfile.TemporaryFile('w+') as errors:
+            process = subprocess.Popen([
+                'ffmpeg', '-y', '-nostats', '-loglevel', 'error', '-i', source,
+                '-vf', 'scale=-2:%s' % code, '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac',
+                '-progress', 'pipe:1', target
+            ], stdout=subprocess.PIPE, stderr=errors, text=True)
+
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+            try:
+                for line in process.stdout:
+                    key, _, value = line.strip().partition('=')
+                    if key == 'out_time_us' and duration and value.isdigit():
+                        progress(min(99, int(int(value) / 1e6 / duration * 100)))
+                process.wait()
+            finally:
+                timer.cancel()
+            errors.seek(0)
+            error = errors.read()
+
+        if process.returncode != 0:
+            raise EncodingError(error.strip() or 'ffmpeg exited with %s' % process.returncode)
+        progress(100)
+
+ENCODERS = {
+    'stub': StubEncoder,
+    'ffmpeg': FfmpegEncoder,
+}
+
+def get_encoder():
+    name = current_app.config['ENCODER']
+    if name == 'auto':
+        name = 'ffmpeg' if shutil.which('ffmpeg') else 'stub'
+    return ENCODERS[name]()
+
+#################
+#### STORAGE ####
+#################
+
+# one upsert on the (video_id, code) unique index, the blob of a replaced uri is released,
+# a new code counts in Video.format_count
+def save_format(videoId, code, uri):
+    previous = db.session.query(Video_Format.uri).filter_by(video_id=videoId, code=code).scalar()
+    upsert = sqlite_insert(Video_Format).values(
+        code = code,
+        uri = uri,
+        video_id = videoId,
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements = ['video_id', 'code'],
+        set_ = {'uri': upsert.excluded.uri}
+    )
+    db.session.execute(upsert)
+    if previous is None:
+        counters.add_formats(videoId)
+    elif previous != uri:
+        blobs.release(previous)
+
+###############
+#### QUEUE ####
+###############
+
+_pool = None
+_wakeup = threading.Event()
+_dispatcher = None
+_app = None # the app the dispatcher serves, the one that started it
+_start_lock = threading.Lock()
+_running = set() # ids of the jobs this process runs, their leases are renewed
+
+def enqueue(video, code):
+    job = Encoding_Job(
+        code = code,
+        status = 'queued',
+        video_id = video.id,
+        created_at = datetime.utcnow(),
+        updated_at = datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+    start()
+    _wakeup.set()
+    return job
+
+def retry(job):
+    job.status = 'queued'
+    job.attempts = 0
+    job.progress = 0
+    job.error = None
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    start()
+    _wakeup.set()
+
+def _update(jobId, **values):
+    values['updated_at'] = datetime.utcnow()
+    Encoding_Job.query.filter_by(id=jobId).update(values)
+    db.session.commit()
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=current_app.config['ENCODING_LEASE'])
+
+# atomically move the oldest queued job to running, None when the queue is empty
+def _claim():
+    while True:
+        job = Encoding_Job.query.filter_by(status='queued').order_by(Encoding_Job.id).first()
+        if job is None:
+            return None
+        claimed = Encoding_Job.query.filter_by(id=job.id, status='queued').update({
+            'status': 'running',
+            'attempts': Encoding_Job.attempts + 1,
+            'lease_until': _lease(),
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed: # another worker process may have taken it first
+            _running.add(job.id)
+            return job.id
+
+def _renew():
+    ids = list(_running)
+    if ids:
+        Encoding_Job.query.filter(Encoding_Job.id.in_(ids), Encoding_Job.status == 'running').update({
+            'lease_until': _lease()
+        }, synchronize_session=False)
+        db.session.commit()
+
+def _run(jobId):
+    with _app.app_context():
+        job = Encoding_Job.query.filter_by(id=jobId).first()
+        video = Video.query.filter_by(id=job.video_id).first()
+        last = [0]
+
+        def progress(percent):
+            if percent - last[0] >= 5 or percent == 100:
+                last[0] = percent
+                _update(jobId, progress=percent)
+
+        try:
+            if video is None or not video.enabled:
+                raise EncodingError('video %s not found' % job.video_id)
+            target = blobs.temp_path() + '.mp4'
+            try:
+                with storage.backend().local_copy(storage.key_of(video.source)) as source:
+                    get_encoder().encode(source, target, job.code, progress, current_app.config['ENCODING_TIMEOUT'])
+                digest, size = blobs.hash_file(target)
+            except Exception:
+                blobs.discard(target)
+                raise
+            save_format(video.id, job.code, blobs.acquire(target, digest, size, '.mp4'))
+            _update(jobId, status='done', progress=100, error=None, lease_until=None)
+            response_cache.invalidate(*response_cache.video_tags(video))
+        except Exception as err:
+            db.session.rollback()
+            job = Encoding_Job.query.filter_by(id=jobId).first()
+            dead = video is None or not video.enabled or job is None or job.attempts >= current_app.config['ENCODING_MAX_ATTEMPTS']
+            _update(jobId, status='dead' if dead else 'queued', progress=0, lease_until=None, error=''.join(traceback.format_exception_only(type(err), err)).strip())
+            _wakeup.set()
+        finally:
+            db.session.remove()
+
+def _dispatch():
+    slots = threading.BoundedSemaphore(_app.config['ENCODING_WORKERS'])
+    while True:
+        _wakeup.wait(min(_app.config['ENCODING_POLL_INTERVAL'], _app.config['ENCODING_LEASE'] / 3))
+        _wakeup.clear()
+        try:
+            with _app.app_context():
+                _renew()
+                requeue() # jobs of the processes that died since
+                db.session.remove()
+        except Exception:
+            _app.logger.exception('encoding lease renewal failed')
+        while slots.acquire(blocking=False):
+            try:
+                with _app.app_context():
+                    jobId = _claim()
+                    db.session.remove()
+            except Exception:
+                jobId = None
+            if jobId is None:
+                slots.release()
+                break
+            future = _pool.submit(_run, jobId)
+            future.add_done_callback(lambda _, jobId=jobId: (_running.discard(jobId), slots.release(), _wakeup.set()))
+
+# running jobs whose lease ran out (their process died) are queued again, the jobs of
+# live processes are left alone. rows claimed before leases existed have none
+def requeue():
+    Encoding_Job.query.filter(
+        Encoding_Job.status == 'running',
+        or_(Encoding_Job.lease_until.is_(None), Encoding_Job.lease_until < datetime.utcnow())
+    ).update({'status': 'queued', 'lease_until': None}, synchronize_session=False)
+    db.session.commit()
+
+# start the dispatcher once per process
+def start(recover=False):
+    global _pool, _dispatcher, _app
+    with _start_lock:
+        if recover:
+            requeue()
+        if _dispatcher is None:
+            _app = current_app._get_current_object()
+            _pool = ThreadPoolExecutor(max_workers=current_app.config['ENCODING_WORKERS'], thread_name_prefix='encoder')
+            _dispatcher = threading.Thread(target=_dispatch, name='encoding-dispatcher', daemon=True)
+            _dispatcher.start()
@@ -0,0 +1,35 @@
+##
+## FILE WHERE WE DEFINE THE SPARSE FIELDSETS
+## ?fields=id,name picks the columns of every item: the SQL loads only those (plus the
+## ones the route needs itself, like the pagination keys) and the serializer is built
+## once per field set (see services/serialization.py). ?include= names the relations
+## to embed. without ?fields= and ?include= a route answers as it always did
+##
+
+from sqlalchemy.orm import load_only
+
+class InvalidFields(ValueError):
+    pass
+
+# 'name,id' -> ('id', 'name') in the order of allowed, None when absent
+def parse(value, allowed):
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    if not names or not names <= set(allowed):
+        raise InvalidFields(value)
+    return tuple(name for name in allowed if name in names)
+
+# (fields or None, set of relations) of the request
+def fieldset(params, allowed, relations=(), defaults=()):
+    fields = parse(params.get('fields'), allowed)
+    include = parse(params.get('include'), relations)
+    if include is None:
+        include = defaults if fields is None else ()
+    return fields, set(include)
+
+# query options loading only the columns of fields and needed, none when fields is None
+def columns(model, fields, needed=()):
+    if fields is None:
+        return []
+    return [load_only(*[getattr(model, name) for name in dict.fromkeys(tuple(needed) + tuple(fields))])]
@@ -0,0 +1,83 @@
+##
+## FILE WHERE WE DEFINE THE PASSWORD HASHING SERVICE
+## bcrypt runs in a small process pool so a burst of logins doesn't starve the
+## request threads, the number of hashes in flight is bounded and callers get
+## HashingBusy (-> 503 + Retry-After) instead of queueing forever
+##
+
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app, has_request_context, request
+import threading
+import time
+import bcrypt
+
+class HashingBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__('password hashing queue is full')
+        self.retry_after = retry_after
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+# route -> [count, total seconds, max seconds]
+_latency = {}
+_latency_lock = threading.Lock()
+
+# executed in the worker processes
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+def _executor():
+    global _pool, _slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = current_app.config['HASH_WORKERS']
+                _slots = threading.BoundedSemaphore(workers + current_app.config['HASH_QUEUE_SIZE'])
+                _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+def _record(seconds):
+    route = request.endpoint if has_request_context() else None
+    with _latency_lock:
+        stats = _latency.setdefault(route or 'none', [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+def _run(fn, *args):
+    start = time.perf_counter()
+    if not current_app.config['HASH_WORKERS']: # inline mode, for dev and tests
+        result = fn(*args)
+    else:
+        pool = _executor()
+        if not _slots.acquire(blocking=False):
+            raise HashingBusy(current_app.config['HASH_RETRY_AFTER'])
+        try:
+            result = pool.submit(fn, *args).result()
+        finally:
+            _slots.release()
+    _record(time.perf_counter() - start)
+    return result
+
+def hash_password(password):
+    return _run(_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+def check_password(pw_hash, password):
+    return _run(_check, pw_hash, password)
+
+# true when the hash was made with another cost factor than the configured one
+def needs_rehash(pw_hash):
+    try:
+        return int(pw_hash.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
+    except (IndexError, ValueError):
+        return True
+
+# {route: {'count', 'total', 'max'}} of hash latencies in seconds
+def latency_stats():
+    with _latency_lock:
+        return {route: {'count': s[0], 'total': s[1], 'max': s[2]} for route, s in _latency.items()}
@@ -0,0 +1,28 @@
+##
+## FILE WHERE WE SERIALIZE VIDEO LISTINGS IN BATCH
+## a page costs one IN-query for formats whatever the page size (instead of a lazy
+## query per video), comments are never loaded: comment_count is a column of video
+##
+
+from collections import defaultdict
+
+from models import Video_Format, VideoListSchema, VideoFormatSchema
+from services.serialization import dump
+
+def _formats_by_video(ids):
+    formats = defaultdict(list)
+    for video_format in Video_Format.query.filter(Video_Format.video_id.in_(ids)).order_by(Video_Format.id):
+        formats[video_format.video_id].append(video_format)
+    return formats
+
+# only: the columns of a sparse fieldset, formats: embed the formats (needs format_count loaded)
+def dump_videos(videos, only=None, formats=True):
+    output = dump(VideoListSchema, videos, only=only, many=True)
+    if not formats:
+        return output
+
+    ids = [video.id for video in videos if video.format_count]
+    by_video = _formats_by_video(ids) if ids else {}
+    for video, item in zip(videos, output):
+        item['formats'] = dump(VideoFormatSchema, by_video.get(video.id, []), many=True)
+    return output
@@ -0,0 +1,12 @@
+##
+## FILE WHERE WE DEFINE THE MEDIA HELPERS SHARED BY THE UPLOAD ROUTES
+##
+
+import magic
+import re
+
+VIDEO_MIMETYPE = re.compile(r'^video\/')
+
+# libmagic sniffing on the first bytes of a file
+def is_video(head):
+    return VIDEO_MIMETYPE.match(magic.from_buffer(head[:1024], mime=True)) is not None
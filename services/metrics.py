@@ -0,0 +1,197 @@
+##
+## FILE WHERE WE DEFINE THE REQUEST INSTRUMENTATION
+## before/after request hooks time every route, SQLAlchemy cursor events count the
+## statements (and their time) of the request that ran them, slow statements are
+## sampled. everything is rendered in the Prometheus text format by GET /metrics.
+## counters live in the process: scrape every worker, or let Prometheus sum them
+## a sampled cProfile trace of a request can be written to METRICS_PROFILE_FOLDER
+##
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import deque
+from datetime import datetime
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, _labels(self.labels, labels), _number(value)))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {} # labels -> [count per bucket..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels + ('le',), labels + (_number(bound),)), count))
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels + ('le',), labels + ('+Inf',)), series[-1]))
+                lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, labels), _number(series[-2])))
+                lines.append('%s_count%s %d' % (self.name, _labels(self.labels, labels), series[-1]))
+        return lines
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+REQUESTS = Counter('api_requests_total', 'Requests by route, method and status.', ('route', 'method', 'status'))
+LATENCY = Histogram('api_request_duration_seconds', 'Request latency by route.', ('route', 'method'), LATENCY_BUCKETS)
+QUERIES = Histogram('api_request_sql_queries', 'SQL statements per request by route.', ('route', 'method'), QUERY_BUCKETS)
+SQL_TIME = Counter('api_sql_duration_seconds_total', 'Time spent in SQL statements by route.', ('route',))
+BYTES_IN = Counter('api_request_bytes_total', 'Request body bytes by route.', ('route',))
+BYTES_OUT = Counter('api_response_bytes_total', 'Response body bytes by route (known lengths only).', ('route',))
+SLOW_QUERIES = Counter('api_slow_queries_total', 'SQL statements slower than METRICS_SLOW_QUERY.', ('route',))
+METRICS = [REQUESTS, LATENCY, QUERIES, SQL_TIME, BYTES_IN, BYTES_OUT, SLOW_QUERIES]
+
+_slow = deque(maxlen=100) # latest slow statements, newest last
+
+# METRICS_* settings of the app serving the request (or running the background task)
+def setting(key):
+    return current_app.config.get(key) if has_app_context() else None
+
+def route():
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return 'background'
+
+#############
+#### SQL ####
+#############
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    name = route()
+    SQL_TIME.inc((name,), seconds)
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+    threshold = setting('METRICS_SLOW_QUERY')
+    if threshold is not None and seconds >= threshold:
+        SLOW_QUERIES.inc((name,))
+        _slow.append({
+            'route': name,
+            'seconds': round(seconds, 6),
+            'statement': ' '.join(statement.split())[:1000],
+            'at': datetime.utcnow().isoformat(),
+        })
+
+def slow_queries():
+    return list(_slow)
+
+###############
+#### HOOKS ####
+###############
+
+def before_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    rate = setting('METRICS_PROFILE_RATE') or 0
+    if rate and random.random() < rate:
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError: # another profiler is already active on this thread
+            g.profiler = None
+
+def after_request(response):
+    if 'request_started' not in g:
+        return response
+    name, method = route(), request.method
+    REQUESTS.inc((name, method, str(response.status_code)))
+    LATENCY.observe((name, method), time.perf_counter() - g.request_started)
+    QUERIES.observe((name, method), g.sql_queries)
+    if request.content_length:
+        BYTES_IN.inc((name,), request.content_length)
+    if response.content_length:
+        BYTES_OUT.inc((name,), response.content_length)
+    return response
+
+def teardown_request(error):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    folder = setting('METRICS_PROFILE_FOLDER')
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        name = '%s-%s-%s.prof' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), request.method, re.sub(r'[^A-Za-z0-9]+', '_', route()).strip('_') or 'root')
+        profiler.dump_stats(os.path.join(folder, name))
+
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+################
+#### OUTPUT ####
+################
+
+# password hashing latency, kept by services/hashing.py
+def _hashing_lines():
+    from services import hashing
+    stats = hashing.latency_stats()
+    lines = []
+    for metric, key, kind, help in (
+        ('api_password_hash_total', 'count', 'counter', 'Password hashes and checks by route.'),
+        ('api_password_hash_seconds_total', 'total', 'counter', 'Time spent hashing passwords by route.'),
+        ('api_password_hash_max_seconds', 'max', 'gauge', 'Slowest password hash by route.'),
+    ):
+        lines += ['# HELP %s %s' % (metric, help), '# TYPE %s %s' % (metric, kind)]
+        lines += ['%s%s %s' % (metric, _labels(('endpoint',), (route,)), _number(s[key])) for route, s in sorted(stats.items())]
+    return lines
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += _hashing_lines()
+    return '\n'.join(lines) + '\n'
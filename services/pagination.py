@@ -0,0 +1,116 @@
+##
+## FILE WHERE WE DEFINE THE PAGINATION HELPERS
+## legacy mode: ?page=&perPage= (OFFSET, total served from a cached count)
+## cursor mode: ?cursor=&limit= (seek on an index, never counts)
+##
+
+from datetime import datetime
+from sqlalchemy import and_, or_
+import base64
+import json
+import math
+
+from services.cache import TTLCache
+
+DEFAULT_PER_PAGE = 20
+MAX_LIMIT = 100
+COUNT_TTL = 60 # seconds a cached COUNT(*) stays valid
+
+_counts = TTLCache(maxsize=1024, ttl=COUNT_TTL)
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, keys):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise InvalidCursor(cursor)
+
+    if type(values) is not list or len(values) != len(keys):
+        raise InvalidCursor(cursor)
+
+    decoded = []
+    for key, value in zip(keys, values):
+        try:
+            if value is not None and key.type.python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif value is not None and type(value) is not key.type.python_type:
+                raise InvalidCursor(cursor)
+        except (TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        decoded.append(value)
+    return decoded
+
+# rows strictly after `values` in (k1, k2, ...) order, written without row values
+# so SQLite can use a composite index on the keys
+def _after(keys, values):
+    clauses = []
+    for i, key in enumerate(keys):
+        equals = [keys[j] == values[j] for j in range(i)]
+        clauses.append(and_(*equals, key > values[i]))
+    return or_(*clauses)
+
+# estimated total rows for a query, cached per compiled statement + params
+def count(query, exact=False):
+    compiled = query.statement.compile()
+    key = (str(compiled), tuple(sorted((k, repr(v)) for k, v in compiled.params.items())))
+
+    total = None if exact else _counts.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        _counts.set(key, total)
+    return total
+
+# forget cached counts, call after inserts/deletes when exactness matters
+def invalidate_counts():
+    _counts.clear()
+
+def is_cursor_request(params):
+    return 'cursor' in params or 'limit' in params
+
+# returns (items, pager) for either mode depending on the query params
+def paginate(query, keys, params):
+    with_count = params.get('count', '').lower() in ('1', 'true', 'exact')
+
+    if is_cursor_request(params):
+        limit = params.get('limit', DEFAULT_PER_PAGE, type=int)
+        if limit is None or limit < 1:
+            limit = DEFAULT_PER_PAGE
+        limit = min(limit, MAX_LIMIT)
+
+        cursor = params.get('cursor')
+        seek = query.order_by(*keys)
+        if cursor:
+            seek = seek.filter(_after(keys, decode_cursor(cursor, keys)))
+
+        rows = seek.limit(limit + 1).all() # one extra row tells us if there is a next page
+        items = rows[:limit]
+        pager = {
+            'limit': limit,
+            'next': encode_cursor([getattr(items[-1], k.key) for k in keys]) if len(rows) > limit else None
+        }
+        if with_count:
+            pager['count'] = count(query, exact=True)
+        return items, pager
+
+    # legacy page/perPage contract, same defaults as paginate(error_out=False)
+    page = params.get('page', 1, type=int)
+    perPage = params.get('perPage', DEFAULT_PER_PAGE, type=int)
+    if page is None or page < 1:
+        page = 1
+    if perPage is None or perPage < 0:
+        perPage = DEFAULT_PER_PAGE
+
+    items = query.limit(perPage).offset((page - 1) * perPage).all()
+    total = count(query, exact=with_count)
+    pager = {
+        'current': page,
+        'total': math.ceil(total / perPage) if perPage else 0 # total of pages for parameter perPage
+    }
+    return items, pager
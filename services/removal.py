@@ -0,0 +1,289 @@
+##
+## FILE WHERE WE DEFINE WHAT GOES AWAY WITH A VIDEO, AN UPLOAD OR A USER
+## a deleted video or user is gone at once for the api (enabled off, out of the search
+## index, tokens revoked) and a Deletion row is queued. a background thread then removes
+## what goes with it: the foreign keys have no ON DELETE, so formats, comments, jobs,
+## uploads and tokens are deleted here, DELETION_BATCH_SIZE rows per transaction so the
+## write lock is never held for long, and the blobs of the deleted uris are released
+## (collected after each commit). every step can run again: a crash just leaves the
+## Deletion row to the next run. a claimed deletion holds a lease renewed between two
+## batches, a running deletion whose lease ran out was left by a dead process and is
+## queued again. the same worker drops the upload sessions idle for UPLOAD_EXPIRY
+##
+
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import or_
+from datetime import datetime, timedelta
+import threading
+import time
+import traceback
+
+from models import Video, Video_Format, Comment, Encoding_Job, Upload, Upload_Chunk, Token, User, Deletion
+from app import db
+from services import blobs, counters, response_cache, search, sessions
+
+# the rows of an upload session, returns its partial file: the caller discards it after
+# the commit (a rollback leaves the session whole)
+def delete_upload(upload):
+    Upload_Chunk.query.filter_by(upload_id=upload.id).delete(synchronize_session=False)
+    db.session.delete(upload)
+    return blobs.partial_path(upload)
+
+# drop the sessions with no write since UPLOAD_EXPIRY, a session written to in the meantime
+# is kept. the partial file goes after the commit
+def expire_uploads():
+    expired = 0
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_EXPIRY'])
+    while True:
+        uploads = _batch(Upload.query.filter(Upload.updated_at < cutoff).order_by(Upload.updated_at))
+        if not uploads:
+            return expired
+        for upload in uploads:
+            path = blobs.partial_path(upload)
+            Upload_Chunk.query.filter_by(upload_id=upload.id).delete(synchronize_session=False)
+            if Upload.query.filter(Upload.id == upload.id, Upload.updated_at < cutoff).delete(synchronize_session=False):
+                db.session.commit()
+                blobs.discard(path)
+                expired += 1
+            else:
+                db.session.rollback()
+        db.session.expunge_all()
+        _pause()
+
+#############
+#### API ####
+#############
+
+def _queue(kind, targetId):
+    now = datetime.utcnow()
+    insert = sqlite_insert(Deletion).values(kind=kind, target_id=targetId, status='queued', attempts=0, created_at=now, updated_at=now)
+    db.session.execute(insert.on_conflict_do_nothing(index_elements=['kind', 'target_id']))
+
+# hide the video now, the rest goes in the background. commits
+def delete_video(video):
+    video.enabled = False
+    search.remove(Video, video.id)
+    _queue('video', video.id)
+    db.session.commit()
+    start()
+    _wakeup.set()
+
+# disable the account and revoke its tokens now, its videos are hidden by the worker first. commits
+def delete_user(user):
+    user.enabled = False
+    search.remove(User, user.id)
+    _queue('user', user.id)
+    db.session.commit()
+    sessions.revoke_user(user.id)
+    start()
+    _wakeup.set()
+
+################
+#### PURGES ####
+################
+
+def _pause():
+    _renew()
+    time.sleep(current_app.config['DELETION_BATCH_PAUSE']) # let the writers queued on the lock in
+
+def _batch(query):
+    return query.limit(current_app.config['DELETION_BATCH_SIZE']).all()
+
+# delete the rows of model matching criteria, one batch per transaction
+def _delete_rows(model, *criteria):
+    deleted = 0
+    while True:
+        ids = [row[0] for row in _batch(db.session.query(model.id).filter(*criteria))]
+        if not ids:
+            return deleted
+        deleted += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        _pause()
+
+# rows holding a blob or a counter are deleted one by one: only the purge whose DELETE
+# matched releases the blob, so two purges of the same video never release it twice
+def purge_video(videoId):
+    while True:
+        rows = _batch(db.session.query(Video_Format.id, Video_Format.uri).filter(Video_Format.video_id == videoId))
+        if not rows:
+            break
+        for formatId, uri in rows:
+            if Video_Format.query.filter_by(id=formatId).delete(synchronize_session=False):
+                blobs.release(uri)
+        db.session.commit()
+        _pause()
+
+    _delete_rows(Comment, Comment.video_id == videoId)
+    _delete_rows(Encoding_Job, Encoding_Job.video_id == videoId)
+
+    source = db.session.query(Video.source).filter(Video.id == videoId).scalar()
+    if Video.query.filter_by(id=videoId).delete(synchronize_session=False):
+        blobs.release(source)
+    search.remove(Video, videoId)
+    db.session.commit()
+
+def purge_user(userId):
+    # hide the videos first, they are listed until then
+    while True:
+        ids = [row[0] for row in _batch(db.session.query(Video.id).filter(Video.user_id == userId, Video.enabled == True))]
+        if not ids:
+            break
+        Video.query.filter(Video.id.in_(ids)).update({'enabled': False}, synchronize_session=False)
+        for videoId in ids:
+            search.remove(Video, videoId)
+        db.session.commit()
+        response_cache.invalidate('videos', 'user:%d:videos' % userId, *('video:%d:comments' % videoId for videoId in ids))
+        _pause()
+
+    while True:
+        ids = [row[0] for row in _batch(db.session.query(Video.id).filter(Video.user_id == userId))]
+        if not ids:
+            break
+        for videoId in ids:
+            purge_video(videoId)
+            _renew() # a video without formats or comments never pauses
+
+    # comments left on the videos of others
+    while True:
+        rows = _batch(db.session.query(Comment.id, Comment.video_id).filter(Comment.user_id == userId))
+        if not rows:
+            break
+        commented = {}
+        for commentId, videoId in rows:
+            if Comment.query.filter_by(id=commentId).delete(synchronize_session=False):
+                commented[videoId] = commented.get(videoId, 0) + 1
+        for videoId, count in commented.items():
+            counters.add_comments(videoId, -count)
+        db.session.commit()
+        response_cache.invalidate('videos', *('video:%d:comments' % videoId for videoId in commented))
+        _pause()
+
+    for upload in Upload.query.filter_by(user_id=userId).all():
+        _delete_rows(Upload_Chunk, Upload_Chunk.upload_id == upload.id)
+        path = delete_upload(upload)
+        db.session.commit()
+        blobs.discard(path)
+        _renew()
+
+    _delete_rows(Token, Token.user_id == userId)
+    User.query.filter_by(id=userId).delete(synchronize_session=False)
+    search.remove(User, userId)
+    db.session.commit()
+    response_cache.invalidate(*response_cache.user_tags(userId))
+
+PURGES = {
+    'video': purge_video,
+    'user': purge_user,
+}
+
+################
+#### WORKER ####
+################
+
+_wakeup = threading.Event()
+_worker = None
+_app = None # the app the worker serves, the one that started it
+_start_lock = threading.Lock()
+_current = None # id of the deletion this process runs
+_renewed_at = 0
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=current_app.config['DELETION_LEASE'])
+
+# called between two batches, after their commit
+def _renew():
+    global _renewed_at
+    if _current is None or time.monotonic() - _renewed_at < current_app.config['DELETION_LEASE'] / 3:
+        return
+    _renewed_at = time.monotonic()
+    Deletion.query.filter_by(id=_current, status='running').update({'lease_until': _lease()}, synchronize_session=False)
+    db.session.commit()
+
+# atomically move the oldest queued deletion to running, None when there is none
+def _claim():
+    while True:
+        deletion = Deletion.query.filter_by(status='queued').order_by(Deletion.id).first()
+        if deletion is None:
+            return None
+        claimed = Deletion.query.filter_by(id=deletion.id, status='queued').update({
+            'status': 'running',
+            'attempts': Deletion.attempts + 1,
+            'lease_until': _lease(),
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed: # another worker process may have taken it first
+            return deletion.id
+
+def _run(deletionId):
+    global _current, _renewed_at
+    deletion = Deletion.query.filter_by(id=deletionId).first()
+    _current, _renewed_at = deletionId, time.monotonic()
+    try:
+        PURGES[deletion.kind](deletion.target_id)
+        Deletion.query.filter_by(id=deletionId).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as err:
+        db.session.rollback()
+        current_app.logger.exception('deletion of %s %s failed', deletion.kind, deletion.target_id)
+        dead = deletion.attempts >= current_app.config['DELETION_MAX_ATTEMPTS']
+        Deletion.query.filter_by(id=deletionId).update({
+            'status': 'dead' if dead else 'queued',
+            'error': ''.join(traceback.format_exception_only(type(err), err)).strip(),
+            'lease_until': None,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+    finally:
+        _current = None
+
+def _loop():
+    swept_at = None
+    while True:
+        _wakeup.wait(_app.config['DELETION_POLL_INTERVAL'])
+        _wakeup.clear()
+        if swept_at is None or time.monotonic() - swept_at >= _app.config['UPLOAD_SWEEP_INTERVAL']:
+            swept_at = time.monotonic()
+            with _app.app_context():
+                try:
+                    expire_uploads()
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('upload sessions sweep failed')
+                finally:
+                    db.session.remove()
+        while True:
+            with _app.app_context():
+                try:
+                    requeue() # deletions of the processes that died since
+                    deletionId = _claim()
+                    if deletionId is None:
+                        break
+                    _run(deletionId)
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('deletion worker failed')
+                    break
+                finally:
+                    db.session.remove()
+
+# running deletions whose lease ran out (their process died) are queued again, the ones
+# of live processes are left alone. rows claimed before leases existed have none
+def requeue():
+    Deletion.query.filter(
+        Deletion.status == 'running',
+        or_(Deletion.lease_until.is_(None), Deletion.lease_until < datetime.utcnow())
+    ).update({'status': 'queued', 'lease_until': None}, synchronize_session=False)
+    db.session.commit()
+
+# start the worker once per process
+def start(recover=False):
+    global _worker, _app
+    with _start_lock:
+        if recover:
+            requeue()
+        if _worker is None:
+            _app = current_app._get_current_object()
+            _worker = threading.Thread(target=_loop, name='deletion-worker', daemon=True)
+            _worker.start()
@@ -0,0 +1,156 @@
+##
+## FILE WHERE WE DEFINE THE RESPONSE CACHE FOR THE PUBLIC GET ROUTES
+## responses are keyed by route + query args + the current version of their tags,
+## write handlers bump the tags they touch (invalidate('video:1', ...)) so stale
+## entries are never read again. every response carries an ETag and If-None-Match
+## gets a 304. backends: 'memory' (per process LRU) or 'sqlite' (a local file shared
+## by every worker of the box)
+##
+
+from flask import current_app, make_response, request
+from functools import wraps
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+
+from services.cache import TTLCache
+
+class MemoryBackend:
+    def __init__(self, maxsize):
+        self.entries = TTLCache(maxsize=maxsize)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, value, ttl=ttl)
+
+    def versions_of(self, tags):
+        return [self.versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def clear(self):
+        self.entries.clear()
+        with self.lock:
+            self.versions.clear()
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript('''
+            CREATE TABLE IF NOT EXISTS entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS tag (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+        ''')
+
+    # one connection per thread, autocommit
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self.connection().execute('SELECT value FROM entry WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO entry (key, value, expires_at) VALUES (?, ?, ?)', (key, pickle.dumps(value), time.time() + ttl))
+        if hash(key) % 100 == 0: # now and then, drop what expired
+            conn.execute('DELETE FROM entry WHERE expires_at <= ?', (time.time(),))
+
+    def versions_of(self, tags):
+        rows = dict(self.connection().execute(
+            'SELECT name, version FROM tag WHERE name IN (%s)' % ', '.join('?' * len(tags)), tags
+        ).fetchall()) if tags else {}
+        return [rows.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        conn = self.connection()
+        for tag in tags:
+            conn.execute('INSERT INTO tag (name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1', (tag,))
+
+    def clear(self):
+        self.connection().executescript('DELETE FROM entry; DELETE FROM tag;')
+
+BACKENDS = {
+    'memory': lambda: MemoryBackend(current_app.config['RESPONSE_CACHE_SIZE']),
+    'sqlite': lambda: SQLiteBackend(current_app.config['RESPONSE_CACHE_PATH']),
+}
+
+_backend_lock = threading.Lock()
+
+# the backend of the current app, built on first use, None when RESPONSE_CACHE is off
+def backend():
+    extensions = current_app.extensions
+    if 'response_cache' not in extensions:
+        with _backend_lock:
+            if 'response_cache' not in extensions:
+                name = current_app.config.get('RESPONSE_CACHE')
+                extensions['response_cache'] = BACKENDS[name]() if name else None
+    return extensions['response_cache']
+
+# call from the write handlers after their commit
+def invalidate(*tags):
+    if backend() is not None and tags:
+        backend().bump(list(tags))
+
+def etag_response(status, body, mimetype, etag):
+    if status == 200 and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(body, status)
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, no-cache' # may store, must revalidate
+    return response
+
+# tags: function of the view kwargs returning the tags the response depends on
+# requests carrying a token are never cached (their payload depends on the caller)
+def cached(tags):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            store = backend()
+            if store is None or request.headers.get('x-token') is not None:
+                return f(*args, **kwargs)
+
+            entity_tags = tags(**kwargs)
+            key = '%s?%s#%s' % (
+                request.path,
+                '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True))),
+                ','.join(str(v) for v in store.versions_of(entity_tags))
+            )
+
+            entry = store.get(key)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                body = response.get_data()
+                entry = (response.status_code, body, response.mimetype, hashlib.sha1(body).hexdigest())
+                store.set(key, entry, current_app.config['RESPONSE_CACHE_TTL'])
+
+            return etag_response(*entry)
+
+        return decorated
+    return decorator
+
+# tags touched by a change to a video / a user
+def video_tags(video):
+    return ('videos', 'user:%d:videos' % video.user_id, 'video:%d:comments' % video.id)
+
+def user_tags(userId):
+    return ('users', 'user:%d' % userId)
@@ -0,0 +1,113 @@
+##
+## FILE WHERE WE DEFINE THE FULL-TEXT SEARCH INDEX
+## backed by SQLite FTS5 tables (rowid = entity id), kept in sync by the routes
+## inside the same transaction as the write they index
+##
+
+from sqlalchemy import or_, text
+from sqlalchemy.exc import OperationalError
+import math
+import re
+
+from app import db
+from models import User, Video
+from services.cache import TTLCache
+from services.pagination import DEFAULT_PER_PAGE, MAX_LIMIT
+
+# model -> (fts table, indexed columns)
+INDEXES = {
+    Video: ('video_search', ('name',)),
+    User: ('user_search', ('username', 'pseudo')),
+}
+
+_ready = None # None until we tried to create the index
+_counts = TTLCache(maxsize=1024, ttl=60)
+_word = re.compile(r'\w+', re.UNICODE)
+
+def _create_index():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with db.engine.begin() as conn:
+            for model, (table, columns) in INDEXES.items():
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+                    % (table, ', '.join(columns))
+                ))
+                # first run on an existing database: backfill from the source table
+                if conn.execute(text('SELECT 1 FROM %s LIMIT 1' % table)).first() is None:
+                    conn.execute(text('INSERT INTO %s(rowid, %s) SELECT id, %s FROM %s' % (
+                        table, ', '.join(columns), ', '.join(columns), model.__tablename__
+                    )))
+    except OperationalError: # sqlite built without fts5
+        return False
+    return True
+
+def available():
+    global _ready
+    if _ready is None:
+        _ready = _create_index()
+    return _ready
+
+# add or refresh an entity, call before the commit of the write
+def index(entity):
+    if not available():
+        return
+    table, columns = INDEXES[type(entity)]
+    db.session.flush() # make sure new rows have their id
+    db.session.execute(text('DELETE FROM %s WHERE rowid = :id' % table), {'id': entity.id})
+    db.session.execute(
+        text('INSERT INTO %s(rowid, %s) VALUES (:id, %s)' % (table, ', '.join(columns), ', '.join(':' + c for c in columns))),
+        dict({'id': entity.id}, **{c: getattr(entity, c) for c in columns})
+    )
+    _counts.clear()
+
+def remove(model, entityId):
+    if not available():
+        return
+    table, columns = INDEXES[model]
+    db.session.execute(text('DELETE FROM %s WHERE rowid = :id' % table), {'id': entityId})
+    _counts.clear()
+
+# turn free text into a safe fts5 query: every word must match, the last one as a prefix
+def match_expression(q):
+    words = _word.findall(q)
+    if not words:
+        return None
+    return ' '.join('"%s"' % w for w in words[:-1]) + (' ' if len(words) > 1 else '') + '"%s"*' % words[-1]
+
+# returns (items, pager) ranked by relevance, same pager shape as the legacy mode
+# options: query options of the items, e.g. a load_only (see services/fields.py)
+def search(model, q, params, options=()):
+    page = params.get('page', 1, type=int)
+    perPage = params.get('perPage', DEFAULT_PER_PAGE, type=int)
+    if page is None or page < 1:
+        page = 1
+    if perPage is None or perPage < 1:
+        perPage = DEFAULT_PER_PAGE
+    perPage = min(perPage, MAX_LIMIT)
+
+    table, columns = INDEXES[model]
+    expression = match_expression(q)
+
+    if expression is None:
+        return [], {'current': page, 'total': 0}
+
+    if not available(): # no fts5, fall back to a substring scan
+        query = model.query.options(*options).filter(or_(*[getattr(model, c).like('%' + q + '%') for c in columns]))
+        items = query.limit(perPage).offset((page - 1) * perPage).all()
+        return items, {'current': page, 'total': math.ceil(query.order_by(None).count() / perPage)}
+
+    ids = [row[0] for row in db.session.execute(
+        text('SELECT rowid FROM %s WHERE %s MATCH :q ORDER BY rank LIMIT :limit OFFSET :offset' % (table, table)),
+        {'q': expression, 'limit': perPage, 'offset': (page - 1) * perPage}
+    )]
+
+    total = _counts.get((table, expression))
+    if total is None:
+        total = db.session.execute(text('SELECT count(*) FROM %s WHERE %s MATCH :q' % (table, table)), {'q': expression}).scalar()
+        _counts.set((table, expression), total)
+
+    rows = {item.id: item for item in model.query.options(*options).filter(model.id.in_(ids))} if ids else {}
+    items = [rows[i] for i in ids if i in rows] # keep the ranking order
+    return items, {'current': page, 'total': math.ceil(total / perPage)}
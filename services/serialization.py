@@ -0,0 +1,139 @@
+##
+## FILE WHERE WE DEFINE THE RESPONSE SERIALIZATION
+## schema instances are built once per (schema, only, many), flat schemas are
+## compiled into plain row -> dict encoders (no marshmallow reflection per row),
+## and jsonify goes through orjson when installed. the bytes are the same as
+## flask.jsonify (sorted keys, ascii, trailing newline), orjson is only used when
+## that holds (compact mode, ascii output, no datetime) and we fall back to the stdlib
+## with the app's json encoder otherwise (datetime, date, UUID, Decimal... as flask)
+##
+
+from flask import current_app
+from marshmallow import fields
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_schemas = {}
+_encoders = {}
+_lock = threading.Lock()
+
+#################
+#### SCHEMAS ####
+#################
+
+def get_schema(schema_cls, only=None, many=False):
+    key = (schema_cls, tuple(only) if only else None, many)
+    schema = _schemas.get(key)
+    if schema is None:
+        with _lock:
+            schema = _schemas.get(key)
+            if schema is None:
+                schema = schema_cls(only=only, many=many)
+                _schemas[key] = schema
+    return schema
+
+# converters matching what the marshmallow field would output, None stays None
+def _iso(value):
+    return value.isoformat()
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+def _converter(field):
+    if type(field) is fields.Boolean:
+        return bool
+    if type(field) is fields.Integer:
+        return int
+    if type(field) is fields.Float:
+        return float
+    if type(field) is fields.String:
+        return _text
+    if type(field) is fields.DateTime and field.format in (None, 'iso', 'iso8601'):
+        return _iso
+    return None # anything else (Nested, Related, custom formats...) stays on marshmallow
+
+# [(output key, attribute, converter)] or None when the schema can't be compiled
+def _compile(schema):
+    plan = []
+    for name, field in schema.dump_fields.items():
+        convert = _converter(field)
+        if convert is None:
+            return None
+        plan.append((field.data_key or name, field.attribute or name, convert))
+    return plan
+
+def _encoder(schema_cls, only):
+    key = (schema_cls, tuple(only) if only else None)
+    if key not in _encoders:
+        _encoders[key] = _compile(get_schema(schema_cls, only))
+    return _encoders[key]
+
+def _encode_row(plan, row):
+    output = {}
+    for key, attribute, convert in plan:
+        value = getattr(row, attribute)
+        output[key] = None if value is None else convert(value)
+    return output
+
+# build the schemas and encoders of [(schema_cls, only, many)] ahead of the first request
+def warm(specs):
+    for schema_cls, only, many in specs:
+        get_schema(schema_cls, only, many)
+        _encoder(schema_cls, only)
+
+# same output as schema_cls(only=only, many=many).dump(obj)
+def dump(schema_cls, obj, only=None, many=False):
+    plan = _encoder(schema_cls, only)
+    if plan is None:
+        return get_schema(schema_cls, only, many).dump(obj)
+    if many:
+        return [_encode_row(plan, row) for row in obj]
+    return _encode_row(plan, obj)
+
+##############
+#### JSON ####
+##############
+
+def dumps(data):
+    config = current_app.config
+    pretty = config.get('JSONIFY_PRETTYPRINT_REGULAR') or current_app.debug
+    sort_keys = config.get('JSON_SORT_KEYS', True)
+    ensure_ascii = config.get('JSON_AS_ASCII', True)
+
+    if orjson is not None and not pretty:
+        try:
+            body = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+            if not ensure_ascii or body.isascii():
+                return body
+        except TypeError: # non str keys, datetimes (flask sends http dates), unknown types... let the stdlib decide
+            pass
+
+    encoder = current_app.json_encoder
+    if pretty:
+        text = json.dumps(data, cls=encoder, indent=2, separators=(', ', ': '), sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+    else:
+        text = json.dumps(data, cls=encoder, separators=(',', ':'), sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+    return (text + '\n').encode('utf-8')
+
+# one compact line whatever the pretty print settings, for newline-delimited JSON
+def dumps_line(data):
+    if orjson is not None:
+        try:
+            body = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS)
+            if body.isascii():
+                return body
+        except TypeError:
+            pass
+    return (json.dumps(data, cls=current_app.json_encoder, separators=(',', ':'), sort_keys=True, ensure_ascii=True) + '\n').encode('utf-8')
+
+# drop-in for flask.jsonify
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else (args or kwargs)
+    return current_app.response_class(dumps(data), mimetype=current_app.config.get('JSONIFY_MIMETYPE', 'application/json'))
@@ -0,0 +1,149 @@
+##
+## FILE WHERE WE DEFINE THE TOKEN STORE
+## every issued token is a Token row keyed by the sha256 of the token. revoked
+## tokens are kept in memory (hash -> expiry) so checking a token is a set lookup,
+## a background thread pulls the revocations made by other workers every
+## TOKEN_REVOCATION_REFRESH seconds and deletes expired rows every TOKEN_SWEEP_INTERVAL.
+## the first load is synchronous (at startup, or by the first request of a process) and
+## a check never waits for the thread: until a load succeeds tokens are refused
+##
+
+from flask import current_app
+from datetime import datetime, timedelta
+import hashlib
+import threading
+import time
+
+from app import db
+from models import Token
+
+SWEEP_BATCH_SIZE = 1000
+CLOCK_SKEW = timedelta(seconds=30) # refreshes overlap by this much, workers' clocks may differ
+RETRY_AFTER = 5 # seconds, when the revocations could not be loaded
+
+class TokenRevoked(Exception):
+    pass
+
+# the revocations were never loaded, no token can be trusted
+class StoreUnavailable(Exception):
+    def __init__(self, retry_after):
+        super().__init__('revoked tokens are not loaded')
+        self.retry_after = retry_after
+
+_revoked = {} # code hash -> expired_at
+_since = None # revoked_at of the latest revocation loaded
+_lock = threading.Lock()
+_worker = None
+_app = None # the app the refresher serves, the one that started it
+_start_lock = threading.Lock()
+_load_lock = threading.Lock()
+_stop = threading.Event()
+_loaded = threading.Event()
+
+def code_hash(token):
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+def create(token, userId, expired_at):
+    db.session.add(Token(
+        code = code_hash(token),
+        expired_at = expired_at,
+        user_id = userId
+    ))
+
+# no SQL, once the store is loaded. raises StoreUnavailable when it cannot be
+def is_revoked(token):
+    start()
+    return code_hash(token) in _revoked
+
+def _remember(rows):
+    global _since
+    with _lock:
+        for code, expired_at, revoked_at in rows:
+            _revoked[code] = expired_at
+            if _since is None or revoked_at > _since:
+                _since = revoked_at
+
+# revoke one token, or every live token of a user, commits
+def revoke(token, expired_at):
+    now = datetime.utcnow()
+    code = code_hash(token)
+    Token.query.filter(Token.code == code, Token.revoked_at.is_(None)).update({'revoked_at': now}, synchronize_session=False)
+    db.session.commit()
+    _remember([(code, expired_at, now)])
+
+def revoke_user(userId):
+    now = datetime.utcnow()
+    rows = db.session.query(Token.code, Token.expired_at).filter(
+        Token.user_id == userId, Token.revoked_at.is_(None), Token.expired_at > now
+    ).all()
+    Token.query.filter(Token.user_id == userId, Token.revoked_at.is_(None)).update({'revoked_at': now}, synchronize_session=False)
+    db.session.commit()
+    _remember([(code, expired_at, now) for code, expired_at in rows])
+
+# load the revocations made since the last refresh (all of them the first time)
+def refresh():
+    now = datetime.utcnow()
+    query = db.session.query(Token.code, Token.expired_at, Token.revoked_at).filter(
+        Token.revoked_at.isnot(None), Token.expired_at > now
+    )
+    if _since is not None:
+        query = query.filter(Token.revoked_at >= _since - CLOCK_SKEW)
+    _remember(query.all())
+    with _lock: # an expired token is refused by jwt.decode anyway
+        for code in [code for code, expired_at in _revoked.items() if expired_at <= now]:
+            del _revoked[code]
+
+# delete expired tokens in small batches so the write lock is never held for long
+def sweep():
+    deleted = 0
+    while True:
+        ids = db.session.query(Token.id).filter(Token.expired_at <= datetime.utcnow()).limit(SWEEP_BATCH_SIZE).all()
+        if not ids:
+            return deleted
+        deleted += Token.query.filter(Token.id.in_([row[0] for row in ids])).delete(synchronize_session=False)
+        db.session.commit()
+
+def _run():
+    swept_at = None
+    while True:
+        with _app.app_context():
+            try:
+                refresh()
+                _loaded.set()
+                if swept_at is None or time.monotonic() - swept_at >= current_app.config['TOKEN_SWEEP_INTERVAL']:
+                    swept_at = time.monotonic()
+                    sweep()
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('token store refresh failed')
+            finally:
+                db.session.remove()
+        if _stop.wait(_app.config['TOKEN_REVOCATION_REFRESH']):
+            return
+
+# the first load, in the caller's thread (needs an app context)
+def load():
+    with _load_lock:
+        if _loaded.is_set():
+            return
+        try:
+            refresh()
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception('token store load failed, refusing tokens')
+            raise StoreUnavailable(RETRY_AFTER)
+        _loaded.set()
+
+# start the worker once per process, the revocations are loaded before it returns
+def start():
+    global _worker, _app
+    if not _loaded.is_set():
+        load()
+    if _worker is None:
+        with _start_lock:
+            if _worker is None:
+                _app = current_app._get_current_object()
+                _worker = threading.Thread(target=_run, name='token-store', daemon=True)
+                _worker.start()
@@ -0,0 +1,147 @@
+##
+## FILE WHERE WE DEFINE THE FILE STORAGE BACKENDS
+## a stored file has a key ('3f/a2/3fa2...9c.mp4' for blobs: two levels of directories
+## taken from the digest, so no directory holds more than a few thousand files) and a
+## uri saved in the database, UPLOAD_FOLDER + key, which is also its public path under
+## /uploads/. backend: 'local' (files under UPLOAD_FOLDER). S3Storage (any S3-compatible
+## store: AWS, or MinIO / localstack through endpoint_url) cannot be selected yet: it
+## stays out of BACKENDS until it has a test against moto or MinIO. scratch files (tmp/,
+## partial/) always stay on the local disk
+##
+
+from flask import current_app
+from contextlib import contextmanager
+import os
+import posixpath
+import shutil
+import threading
+
+
+try:
+    import boto3
+except ImportError: # only needed by S3Storage
+    boto3 = None
+
+class LocalStorage:
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    # store the file at `path` under key, `path` is left in place
+    def put(self, key, path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(path, target) # same disk: instant, and never overwrites
+        except FileExistsError:
+            pass
+        except OSError: # another filesystem, or links not supported
+            partial = target + '.part'
+            shutil.copyfile(path, partial)
+            os.replace(partial, target)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def local_copy(self, key):
+        yield self.path(key)
+
+class S3Storage:
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None, url_expires=3600):
+        if boto3 is None:
+            raise RuntimeError('S3Storage needs boto3 (pip install boto3)')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires = url_expires
+        self.client = boto3.client(
+            's3',
+            endpoint_url = endpoint_url,
+            region_name = region,
+            aws_access_key_id = access_key,
+            aws_secret_access_key = secret_key,
+        )
+
+    def object_key(self, key):
+        return self.prefix + key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except self.client.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, key, path):
+        self.client.upload_file(path, self.bucket, self.object_key(key)) # multipart above 8 MB
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    # time-limited GET url, the store answers Range requests itself
+    def url(self, key):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.object_key(key)}, ExpiresIn=self.url_expires
+        )
+
+    # the encoders need a real file
+    @contextmanager
+    def local_copy(self, key):
+        from services.blobs import temp_path
+        path = temp_path() + os.path.splitext(key)[1]
+        self.client.download_file(self.bucket, self.object_key(key), path)
+        try:
+            yield path
+        finally:
+            os.remove(path)
+
+# the values of STORAGE_BACKEND, S3Storage joins them once it is tested
+BACKENDS = {
+    'local': lambda: LocalStorage(current_app.config['UPLOAD_FOLDER']),
+}
+
+_backend_lock = threading.Lock()
+
+# the backend of the current app, built on first use
+def backend():
+    extensions = current_app.extensions
+    if 'storage' not in extensions:
+        with _backend_lock:
+            if 'storage' not in extensions:
+                name = current_app.config.get('STORAGE_BACKEND', 'local')
+                if name not in BACKENDS:
+                    raise RuntimeError('unknown STORAGE_BACKEND %r, available: %s' % (name, ', '.join(sorted(BACKENDS))))
+                extensions['storage'] = BACKENDS[name]()
+    return extensions['storage']
+
+# 'uploads/3f/a2/3fa2...9c.mp4' <-> '3f/a2/3fa2...9c.mp4'
+def key_of(uri):
+    folder = current_app.config['UPLOAD_FOLDER']
+    return uri[len(folder):] if uri.startswith(folder) else uri
+
+def uri_of(key):
+    return current_app.config['UPLOAD_FOLDER'] + key
+
+def blob_key(digest, ext=''):
+    depth = current_app.config.get('STORAGE_SHARD_DEPTH', 2)
+    return '/'.join([digest[2 * i:2 * i + 2] for i in range(depth)] + [digest + ext])
+
+# scratch areas of the upload folder, never served. checked on the normalized key,
+# 'x/../tmp/<id>' is tmp/<id>
+def is_scratch(key):
+    key = posixpath.normpath('/' + key).lstrip('/')
+    return key.split('/', 1)[0] in ('tmp', 'partial')
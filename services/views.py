@@ -0,0 +1,99 @@
+##
+## FILE WHERE WE COUNT VIDEO VIEWS (WRITE-BEHIND)
+## playbacks are added to an in-memory sharded counter and a background thread
+## flushes the aggregated deltas every VIEW_FLUSH_INTERVAL seconds in one
+## UPDATE ... SET view = view + CASE id ... statement. deltas are additive so every
+## worker process can flush its own counter, a crash loses at most one interval
+##
+
+from flask import current_app
+from sqlalchemy import case, func
+import atexit
+import threading
+
+from app import db
+from models import Video, Video_Format
+from services.cache import TTLCache
+
+SHARDS = 16
+BATCH_SIZE = 500 # ids per UPDATE, stays under SQLite's bound parameter limit
+
+_shards = [({}, threading.Lock()) for _ in range(SHARDS)]
+_flusher = None
+_app = None # the app the flusher serves, the one that started it
+_start_lock = threading.Lock()
+_stop = threading.Event()
+_files = TTLCache(maxsize=10000, ttl=300) # upload filename -> video id
+
+def record(videoId, count=1):
+    counts, lock = _shards[hash(videoId) % SHARDS]
+    with lock:
+        counts[videoId] = counts.get(videoId, 0) + count
+    start()
+
+# map a file served from /uploads/<filename> back to its video (source or encoded format)
+def video_for_file(filename):
+    videoId = _files.get(filename)
+    if videoId is None:
+        uri = current_app.config['UPLOAD_FOLDER'] + filename
+        row = db.session.query(Video.id).filter(Video.source == uri).first() or \
+            db.session.query(Video_Format.video_id).filter(Video_Format.uri == uri).first()
+        videoId = row[0] if row else 0 # 0: not a video, cached too
+        _files.set(filename, videoId)
+    return videoId or None
+
+def record_file(filename):
+    videoId = video_for_file(filename)
+    if videoId is not None:
+        record(videoId)
+
+# empty every shard and merge them. the dicts are emptied in place under their lock, never
+# replaced: record() picks its dict before taking the lock
+def _drain():
+    merged = {}
+    for counts, lock in _shards:
+        with lock:
+            snapshot = dict(counts)
+            counts.clear()
+        for videoId, count in snapshot.items():
+            merged[videoId] = merged.get(videoId, 0) + count
+    return merged
+
+def flush():
+    deltas = _drain()
+    if not deltas:
+        return 0
+    ids = list(deltas)
+    with _app.app_context():
+        try:
+            for i in range(0, len(ids), BATCH_SIZE):
+                batch = ids[i:i + BATCH_SIZE]
+                db.session.query(Video).filter(Video.id.in_(batch)).update({
+                    Video.view: func.coalesce(Video.view, 0) + case({videoId: deltas[videoId] for videoId in batch}, value=Video.id)
+                }, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for videoId, count in deltas.items(): # put them back for the next flush
+                record(videoId, count)
+            raise
+        finally:
+            db.session.remove()
+    return sum(deltas.values())
+
+def _run():
+    while not _stop.wait(_app.config['VIEW_FLUSH_INTERVAL']):
+        try:
+            flush()
+        except Exception:
+            _app.logger.exception('view counter flush failed')
+
+def start():
+    global _flusher, _app
+    if _flusher is None:
+        with _start_lock:
+            if _flusher is None:
+                _app = current_app._get_current_object()
+                _flusher = threading.Thread(target=_run, name='view-counter', daemon=True)
+                _flusher.start()
+                atexit.register(flush)